@@ -1,8 +1,20 @@
-from . import core
-from . import preprocess
-from . import utils
-from . import plot
-from . import evaluate
-from . import genescores
-from . import accessibility
-from .version import __version__
\ No newline at end of file
+import importlib
+
+from .version import __version__
+
+# Submodules are imported on first access (PEP 562), so that importing the package does not load the plotting
+# and genomics dependencies of modules that are not used.
+_submodules = ['core', 'preprocess', 'utils', 'plot', 'evaluate', 'genescores', 'accessibility', 'chromvar',
+               'aggregate', 'build_graph', 'diffusion', 'distributed', 'instrument']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        module = importlib.import_module(f'.{name}', __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules))
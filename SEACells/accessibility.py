@@ -3,82 +3,132 @@ import pandas as pd
 from tqdm import tqdm
 
 
+def _open_peaks_per_block(frag_counts, n_frags, glambda, pval_cutoff, seed):
+    """
+    Identify open peaks in a block of metacells (see determine_metacell_open_peaks).
+
+    :param frag_counts: (sparse matrix) n_metacells_in_block x n_peaks neighbor-boosted fragment counts
+    :param n_frags: (int) number of fragments sampled per metacell
+    :param glambda: (float) mean of the Poisson background
+    :param pval_cutoff: (float) p-value cutoff for open peaks
+    :param seed: (np.random.SeedSequence) seed of the random number generator of the block
+    :return: (sparse matrix) n_metacells_in_block x n_peaks boolean matrix of open peaks
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.stats import poisson
+
+    frag_distr = frag_counts.toarray()
+    totals = frag_distr.sum(axis=1, keepdims=True)
+
+    # Multinomial distribution, uniform for metacells without fragments
+    frag_distr = np.divide(frag_distr, totals, out=np.full(frag_distr.shape, 1 / frag_distr.shape[1]),
+                           where=totals > 0)
+    sampled = np.random.default_rng(seed).multinomial(n_frags, frag_distr)
+
+    # Significant peaks. Cutoffs are undefined without sampled fragments, and no peaks are open.
+    n_sampled_peaks = (sampled > 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cutoffs = poisson.ppf(1 - pval_cutoff / n_sampled_peaks, glambda)
+    return csr_matrix(sampled >= cutoffs[:, None])
+
+
 def determine_metacell_open_peaks(atac_meta_ad, peak_set=None, low_dim_embedding='X_svd', pval_cutoff=1e-2,
-                                  read_len=147, n_neighbors=3, n_jobs=1):
+                                  read_len=147, n_neighbors=3, n_jobs=1, random_state=0):
     """
-    TODO: Docstring
+    Identify open peaks in each metacell. Fragment counts of each metacell are boosted with those of its nearest
+    metacells, and a fixed number of fragments is sampled from the resulting distribution over peaks. Peaks whose
+    sampled counts are significantly higher than expected from a uniform Poisson background are open, with a
+    Bonferroni correction for the number of peaks with fragments. Results are stored in
+    atac_meta_ad.layers['OpenPeaks'] as a sparse boolean matrix.
+
+    :param atac_meta_ad: (AnnData) ATAC metacell AnnData with fragment counts and n_counts per metacell
+    :param peak_set: (list) peaks to test. If None, all peaks are tested. Other peaks are not open.
+    :param low_dim_embedding: (str) key of atac_meta_ad.obsm with the embedding used to find neighboring metacells
+    :param pval_cutoff: (float) p-value cutoff for open peaks
+    :param read_len: (int) fragment length for the background distribution
+    :param n_neighbors: (int) number of nearest metacells, including the metacell, whose fragments are combined
+    :param n_jobs: (int) number of parallel jobs
+    :param random_state: (int) seed of the random number generators used for sampling fragments
     """
     from sklearn.neighbors import NearestNeighbors
-    from scipy.stats import poisson, multinomial
+    from scipy.sparse import csr_matrix, vstack
 
     # Effective genome length for background computaiton
     eff_genome_length = atac_meta_ad.shape[1] * 5000
 
-    # Set up container
+    # Peaks to test
     if peak_set is None:
-        peak_set = atac_meta_ad.var_names
-    open_peaks = pd.DataFrame(
-        0, index=atac_meta_ad.obs_names, columns=peak_set)
+        peak_ix = np.arange(atac_meta_ad.shape[1])
+    else:
+        peak_ix = atac_meta_ad.var_names.get_indexer(peak_set)
+        if np.any(peak_ix < 0):
+            raise ValueError(f'Peaks {list(pd.Index(peak_set)[peak_ix < 0][:5])} are not present in AnnData.')
 
     # Metacell neighbors
     nbrs = NearestNeighbors(n_neighbors=n_neighbors)
     nbrs.fit(atac_meta_ad.obsm[low_dim_embedding])
-    meta_nbrs = pd.DataFrame(atac_meta_ad.obs_names.values[nbrs.kneighbors(atac_meta_ad.obsm[low_dim_embedding])[1]],
-                             index=atac_meta_ad.obs_names)
-
-    for m in tqdm(open_peaks.index):
-        # Boost using local neighbors
-        frag_counts = np.ravel(
-            atac_meta_ad[meta_nbrs.loc[m, :].values, :][:, peak_set].X.sum(axis=0))
-        frag_distr = frag_counts / np.sum(frag_counts).astype(np.float64)
-
-        # Multinomial distribution
-        while not 0 < np.sum(frag_distr) < 1 - 1e-5:
-            frag_distr = np.absolute(frag_distr - np.finfo(np.float32).epsneg)
-        # Sample from multinomial distribution
-        frag_counts = multinomial.rvs(np.percentile(
-            atac_meta_ad.obs['n_counts'], 100), frag_distr)
-
-        # Compute background poisson distribution
-        total_frags = frag_counts.sum()
-        glambda = (read_len * total_frags) / eff_genome_length
-
-        # Significant peaks
-        cutoff = pval_cutoff / np.sum(frag_counts > 0)
-        open_peaks.loc[m, frag_counts >= poisson.ppf(1 - cutoff, glambda)] = 1
-
-    # Update ATAC Metadata object
-    atac_meta_ad.layers['OpenPeaks'] = open_peaks.values
+    nbr_ix = nbrs.kneighbors(atac_meta_ad.obsm[low_dim_embedding])[1]
+    n = atac_meta_ad.shape[0]
+    nbr_matrix = csr_matrix((np.ones(nbr_ix.size), (np.repeat(np.arange(n), nbr_ix.shape[1]), nbr_ix.ravel())),
+                            shape=(n, n))
+
+    # Boost using local neighbors
+    frag_counts = csr_matrix(nbr_matrix @ csr_matrix(atac_meta_ad.X)[:, peak_ix])
+    n_frags = int(np.percentile(atac_meta_ad.obs['n_counts'], 100))
+
+    # Compute background poisson distribution: sampled profiles have n_frags fragments
+    glambda = (read_len * n_frags) / eff_genome_length
+
+    # Metacells are processed in fixed blocks of at most 100 dense profiles, each with an independent random number
+    # stream, so that results do not depend on the number of jobs
+    from joblib import Parallel, delayed
+    block_size = max(1, min(100, int(1e7 // max(len(peak_ix), 1))))
+    starts = range(0, n, block_size)
+    seeds = np.random.SeedSequence(random_state).spawn(len(starts))
+    open_peaks = Parallel(n_jobs=n_jobs)(delayed(_open_peaks_per_block)(frag_counts[start:start + block_size],
+                                                                        n_frags,
+                                                                        glambda,
+                                                                        pval_cutoff,
+                                                                        seed)
+                                         for start, seed in zip(tqdm(starts), seeds))
+
+    # Update ATAC Metadata object, with columns of all peaks
+    open_peaks = vstack(open_peaks).tocoo()
+    atac_meta_ad.layers['OpenPeaks'] = csr_matrix((open_peaks.data, (open_peaks.row, peak_ix[open_peaks.col])),
+                                                  shape=atac_meta_ad.shape, dtype=bool)
 
 
 def get_gene_accessibility(atac_meta_ad, gene_peak_cors, gene_set=None, pval_cutoff=1e-1, cor_cutoff=0.1):
     """
-    TODO: Docstring
+    Compute the fraction of open peaks among the peaks associated with each gene, in each metacell. Genes without
+    peaks have a gene accessibility of -1, and genes without associated peaks have a gene accessibility of NaN.
+    Results are stored in atac_meta_ad.obsm['GeneAccessibility'].
+
+    :param atac_meta_ad: (AnnData) ATAC metacell AnnData with open peaks (see determine_metacell_open_peaks)
+    :param gene_peak_cors: (pd.Series or pd.DataFrame) output of genescores.get_gene_peak_correlations
+    :param gene_set: (list) genes for which accessibility is computed. If None, all genes are used.
+    :param pval_cutoff: (float) p-value cutoff for gene-peak associations
+    :param cor_cutoff: (float) correlation cutoff for gene-peak associations
     """
+    from .genescores import _gene_peak_weights
 
     if 'OpenPeaks' not in atac_meta_ad.layers.keys():
         raise Exception(
             "Run determine_metacell_open_peaks to compute gene accessibility")
-    open_peaks = pd.DataFrame(atac_meta_ad.layers['OpenPeaks'],
-                              index=atac_meta_ad.obs_names, columns=atac_meta_ad.var_names)
-
-    if gene_set is None:
-        gene_set = gene_peak_cors.index
-
-    # Container
-    gene_accessiblity = pd.DataFrame(-1,
-                                     index=atac_meta_ad.obs_names, columns=gene_set)
-    for gene in tqdm(gene_set):
-        df = gene_peak_cors[gene]
-
-        # Skip if there no correlated peaks
-        if type(df) is int:
-            continue
-        gene_peaks = df.index[(df['pval'] < pval_cutoff)
-                              & (df['cor'] > cor_cutoff)]
-
-        # Identify fraction open
-        s = open_peaks.loc[:, gene_peaks].sum(axis=1)
-        gene_accessiblity.loc[s.index, gene] = s.values / len(gene_peaks)
 
-    atac_meta_ad.obsm['GeneAccessibility'] = gene_accessiblity
+    # Indicator matrix of peaks associated with each gene
+    associated, gene_set, has_peaks = _gene_peak_weights(gene_peak_cors, atac_meta_ad.var_names,
+                                                         pval_cutoff, cor_cutoff, genes=gene_set)
+    associated.data[:] = 1
+    n_peaks = np.ravel(associated.sum(axis=0))
+
+    # Identify fraction open
+    n_open = atac_meta_ad.layers['OpenPeaks'] @ associated
+    if hasattr(n_open, 'toarray'):
+        n_open = n_open.toarray()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gene_accessiblity = np.asarray(n_open, dtype=np.float64) / n_peaks
+    gene_accessiblity[:, ~has_peaks] = -1
+
+    atac_meta_ad.obsm['GeneAccessibility'] = pd.DataFrame(gene_accessiblity,
+                                                          index=atac_meta_ad.obs_names, columns=gene_set)
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, diags, issparse
+
+
+def SEACell_indicator(labels, groups=None):
+    """
+    Construct the sparse indicator matrix mapping cells to SEACells, so that aggregating data over SEACells
+    reduces to a single sparse matrix product.
+
+    :param labels: (array-like) SEACell label of each cell. Cells with missing labels are not assigned.
+    :param groups: (array-like) SEACells to include, in order. If None, SEACells are ordered by first appearance.
+    :return: (1) (sparse matrix) n_SEACells x n_cells CSR matrix with a 1 for each cell in its SEACell and
+             (2) pd.Index of SEACells
+    """
+    labels = pd.Series(np.asarray(labels))
+    if groups is None:
+        groups = labels.dropna().unique()
+    groups = pd.Index(groups)
+
+    codes = groups.get_indexer(labels)
+    cells = np.where(codes >= 0)[0]
+    indicator = csr_matrix((np.ones(len(cells)), (codes[cells], cells)), shape=(len(groups), len(labels)))
+    return indicator, groups
+
+
+def aggregate(X, indicator, mode='sum'):
+    """
+    Aggregate rows of a data matrix over SEACells.
+
+    :param X: (array or sparse matrix) n_cells x n_features data matrix
+    :param indicator: (sparse matrix) n_SEACells x n_cells matrix of cell weights per SEACell,
+                    e.g. from SEACell_indicator() or soft assignments
+    :param mode: (str) 'sum' to sum over cells, or 'mean' to compute the weighted mean over cells
+    :return: (sparse matrix) n_SEACells x n_features CSR matrix of aggregated data
+    """
+    if mode not in ('sum', 'mean'):
+        raise ValueError(f'Mode {mode} is not supported. Use "sum" or "mean".')
+
+    indicator = csr_matrix(indicator)
+    if mode == 'mean':
+        totals = np.ravel(indicator.sum(axis=1))
+        indicator = diags(np.divide(1., totals, out=np.zeros(len(totals)), where=totals != 0)) @ indicator
+
+    if issparse(X):
+        return csr_matrix(indicator @ X)
+    return csr_matrix(indicator @ np.asarray(X))
+
+
+def _one_hot(codes, n_categories):
+    """Sparse n_cells x n_categories indicator matrix of category codes. Cells with negative codes are excluded."""
+    cells = np.where(codes >= 0)[0]
+    return csr_matrix((np.ones(len(cells)), (cells, codes[cells])), shape=(len(codes), max(n_categories, 1)))
+
+
+def category_counts(values, indicator):
+    """
+    Count the cells of each category in each SEACell.
+
+    :param values: (array-like) category of each cell. Missing values are not counted.
+    :param indicator: (sparse matrix) n_SEACells x n_cells indicator matrix, e.g. from SEACell_indicator()
+    :return: (1) (array) n_SEACells x n_categories matrix of counts and (2) pd.Index of categories
+    """
+    codes, categories = pd.factorize(values)
+    counts = (csr_matrix(indicator) @ _one_hot(codes, len(categories))).toarray()
+    return counts, pd.Index(categories)
+
+
+def category_composition(values, indicator):
+    """
+    Composition of a categorical annotation in each SEACell: the fraction of cells of each category, the most
+    frequent category, its fraction (purity) and the entropy of the fractions. Ties between most frequent
+    categories are resolved towards the category appearing first among the cells of the SEACell. SEACells
+    without annotated cells have missing values.
+
+    :param values: (array-like) category of each cell. Missing values are not counted.
+    :param indicator: (sparse matrix) n_SEACells x n_cells indicator matrix, e.g. from SEACell_indicator()
+    :return: (1) (pd.DataFrame) n_SEACells x n_categories fractions of cells of each category,
+             (2) (array) most frequent category, (3) (array) purity and (4) (array) entropy of each SEACell
+    """
+    indicator = csr_matrix(indicator)
+    codes, categories = pd.factorize(values)
+    counts = (indicator @ _one_hot(codes, len(categories))).toarray()[:, :len(categories)]
+    totals = counts.sum(axis=1)
+    observed = totals > 0
+
+    # First cell of each category in each SEACell, to resolve ties
+    cells = indicator.tocoo()
+    annotated = codes[cells.col] >= 0
+    last = np.iinfo(np.int64).max
+    first = np.full(counts.shape, last, dtype=np.int64)
+    np.minimum.at(first, (cells.row[annotated], codes[cells.col[annotated]]), cells.col[annotated])
+    is_max = counts == counts.max(axis=1, keepdims=True, initial=0)
+    majority = np.argmin(np.where(is_max, first, last), axis=1) if len(categories) > 0 \
+        else np.zeros(len(counts), dtype=np.int64)
+
+    fractions = np.divide(counts, totals[:, None], out=np.full(counts.shape, np.nan), where=observed[:, None])
+    most_frequent = np.full(len(counts), np.nan, dtype=object)
+    most_frequent[observed] = np.asarray(categories, dtype=object)[majority[observed]]
+    purity = np.where(observed, np.max(fractions, axis=1, initial=0, where=observed[:, None]), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = np.sum(np.where(fractions > 0, -fractions * np.log(fractions), 0), axis=1)
+    entropy[~observed] = np.nan
+
+    return pd.DataFrame(fractions, columns=pd.Index(categories)), most_frequent, purity, entropy
+
+
+def aggregate_obs(obs, indicator, columns=None):
+    """
+    Aggregate cell annotations over SEACells. Numeric columns are averaged over the cells of each SEACell, ignoring
+    missing values, and other columns are summarized by their most frequent value.
+
+    :param obs: (pd.DataFrame) n_cells x n_annotations cell annotations
+    :param indicator: (sparse matrix) n_SEACells x n_cells indicator matrix, e.g. from SEACell_indicator()
+    :param columns: (list) columns of obs to aggregate. If None, all columns are aggregated.
+    :return: (pd.DataFrame) n_SEACells x n_columns aggregated annotations
+    """
+    indicator = csr_matrix(indicator)
+    if columns is None:
+        columns = obs.columns
+
+    summary = {}
+    for col in columns:
+        values = obs[col]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            values = values.values.astype(float)
+            observed = ~np.isnan(values)
+            totals = indicator @ np.where(observed, values, 0)
+            counts = indicator @ observed.astype(float)
+            summary[col] = np.divide(totals, counts, out=np.full(len(counts), np.nan), where=counts != 0)
+        else:
+            _, mode, _, _ = category_composition(values, indicator)
+            summary[col] = pd.Categorical(mode)
+
+    return pd.DataFrame(summary)
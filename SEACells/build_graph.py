@@ -1,15 +1,11 @@
 import numpy as np
-from scipy.sparse import coo_matrix, csr_matrix, dok_matrix, lil_matrix, diags, eye, csc_matrix, kron, vstack
-from sklearn.neighbors import kneighbors_graph, radius_neighbors_graph
-from scipy.sparse.linalg import svds, eigs, eigsh, norm, spsolve
-from scipy.spatial.distance import cdist
-from scipy.special import logsumexp
-from scipy.stats import t, entropy, multinomial
+from scipy.sparse import csr_matrix, lil_matrix, diags
 
 # for parallelizing stuff
-from multiprocessing import cpu_count, Pool
-from joblib import Parallel, delayed
-from tqdm.notebook import tqdm
+from multiprocessing import cpu_count
+from tqdm.auto import tqdm
+
+from .instrument import FitMonitor
 
 # optimization
 import time
@@ -67,13 +63,89 @@ def rbf_for_row(G, data, median_distances, i):
     return lil_matrix(masked_row)
 
 
+
+##########################################################
+# Helper functions for updating sparse graphs in place
+##########################################################
+
+def _csr_rows_to_padded(G, rows):
+    """
+    Convert rows of a sparse matrix to dense arrays of values and column indices, padded with inf and -1
+
+    :param G: (sparse matrix) CSR matrix
+    :param rows: (array) indices of rows to convert
+    :return: (array, array) values and column indices with one row per selected row
+    """
+    sub = G[rows]
+    counts = np.diff(sub.indptr)
+    width = counts.max() if len(counts) else 0
+    values = np.full((len(rows), width), np.inf)
+    columns = np.full((len(rows), width), -1)
+    row_ix = np.repeat(np.arange(len(rows)), counts)
+    col_ix = np.arange(sub.nnz) - np.repeat(sub.indptr[:-1], counts)
+    values[row_ix, col_ix] = sub.data
+    columns[row_ix, col_ix] = sub.indices
+    return values, columns
+
+
+def _nearest_columns(values, columns, k):
+    """
+    Keep the k smallest values in each row, ignoring repeated columns
+
+    :param values: (array) distances, with inf for missing entries
+    :param columns: (array) column index of each distance
+    :param k: (int) number of entries to keep per row
+    :return: (array, array) distances and columns of the k nearest entries of each row
+    """
+    # sort each row by column, then by distance, to remove duplicate columns
+    order = np.lexsort((values, columns), axis=-1)
+    values = np.take_along_axis(values, order, axis=1)
+    columns = np.take_along_axis(columns, order, axis=1)
+    duplicate = np.zeros(columns.shape, dtype=bool)
+    duplicate[:, 1:] = columns[:, 1:] == columns[:, :-1]
+    values[duplicate] = np.inf
+
+    order = np.argsort(values, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(values, order, axis=1), np.take_along_axis(columns, order, axis=1)
+
+
+def _padded_to_csr(values, columns, n):
+    """
+    Convert padded dense arrays of values and column indices to a sparse matrix with n columns
+    """
+    keep = np.isfinite(values) & (columns >= 0)
+    rows = np.repeat(np.arange(values.shape[0]), values.shape[1]).reshape(values.shape)
+    G = csr_matrix((values[keep], (rows[keep], columns[keep])), shape=(values.shape[0], n))
+    G.eliminate_zeros()
+    return G
+
+
+def _replace_rows(G, rows, new_rows, shape):
+    """
+    Resize sparse matrix G to shape and replace the given rows
+
+    :param G: (sparse matrix) CSR matrix
+    :param rows: (array) indices of rows to replace
+    :param new_rows: (sparse matrix) len(rows) x shape[1] matrix of replacement rows
+    :param shape: (int, int) shape of the output matrix
+    :return: (sparse matrix) updated CSR matrix
+    """
+    G = G.tocsr(copy=True)
+    G.resize(shape)
+    keep = np.ones(shape[0])
+    keep[rows] = 0
+    placement = csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(shape[0], len(rows)))
+    G = (diags(keep) @ G + placement @ new_rows).tocsr()
+    G.eliminate_zeros()
+    return G
+
 ##########################################################
 # Archetypal Analysis Metacell Graph
 ##########################################################
 
 class SEACellGraph:
 
-    def __init__(self, ad, build_on='X_pca', n_cores: int = -1, verbose: bool = False):
+    def __init__(self, ad, build_on='X_pca', n_cores: int = -1, verbose: bool = False, monitor=None):
         """
 
         :param ad: (anndata.AnnData) object containing data for which metacells are computed
@@ -82,6 +154,8 @@ class SEACellGraph:
         :param n_cores: (int) number of cores for multiprocessing. If unspecified, computed automatically as
                         number of CPU cores
         :param verbose: (bool) whether or not to suppress verbose program logging
+        :param monitor: (instrument.FitMonitor) records time and memory of each phase of kernel construction.
+                        If None, a new monitor is created.
         """
 
         """Initialize model parameters"""
@@ -105,8 +179,16 @@ class SEACellGraph:
         self.G = None  # graph
         self.T = None  # transition matrix
 
+        self.K = None  # kernel matrix
+        self.knn_distances = None  # kNN graph with distances, excluding self
+        self.sym_graph = None  # symmetrized kNN graph the kernel is supported on
+        self.k = None  # number of neighbors used for the kernel
+        self.median_distances = None  # adaptive bandwidth of each point
+        self.nn_index = None  # nearest neighbor index over the data, built on demand
+
         # model params
         self.verbose = verbose
+        self.monitor = monitor if monitor is not None else FitMonitor()
 
     ##############################################################
     # Methods related to kernel + sim matrix construction
@@ -121,57 +203,218 @@ class SEACellGraph:
         """
 
         import scanpy as sc
+        from joblib import Parallel, delayed
 
         if self.verbose:
             print("Computing kNN graph using scanpy NN ...")
 
         # compute kNN and the distance from each point to its nearest neighbors
-        sc.pp.neighbors(self.ad, use_rep=self.build_on, n_neighbors=k, knn=True)
-        knn_graph_distances = self.ad.obsp['distances']
+        with self.monitor.phase('knn'):
+            sc.pp.neighbors(self.ad, use_rep=self.build_on, n_neighbors=k, knn=True)
+            knn_graph_distances = self.ad.obsp['distances']
 
-        # Binarize distances to get connectivity
-        knn_graph = knn_graph_distances.copy()
-        knn_graph[knn_graph != 0] = 1
-        # Include self as neighbour
-        knn_graph.setdiag(1)
+            # Binarize distances to get connectivity
+            knn_graph = knn_graph_distances.copy()
+            knn_graph[knn_graph != 0] = 1
+            # Include self as neighbour
+            knn_graph.setdiag(1)
 
         if self.verbose:
             print("Computing radius for adaptive bandwidth kernel...")
 
             # compute median distance for each point amongst k-nearest neighbors
-        with Parallel(n_jobs=self.num_cores, backend="threading") as parallel:
-            median = k // 2
-            median_distances = parallel(
-                delayed(kth_neighbor_distance)(knn_graph_distances, median, i) for i in tqdm(range(self.n)))
-
-        # convert to numpy array
-        median_distances = np.array(median_distances)
+        with self.monitor.phase('bandwidths'):
+            with Parallel(n_jobs=self.num_cores, backend="threading") as parallel:
+                median = k // 2
+                median_distances = parallel(
+                    delayed(kth_neighbor_distance)(knn_graph_distances, median, i)
+                    for i in tqdm(range(self.n), disable=not self.verbose))
+
+            # convert to numpy array
+            median_distances = np.array(median_distances)
+        self.k = k
+        self.median_distances = median_distances
 
         # take AND
 
+        with self.monitor.phase('rbf'):
+            if self.verbose:
+                print("Making graph symmetric...")
+            sym_graph = (knn_graph + knn_graph.T > 0).astype(float)
+            self.knn_distances = knn_graph_distances
+            self.sym_graph = sym_graph
+
+            if self.verbose:
+                print("Computing RBF kernel...")
+
+            with Parallel(n_jobs=self.num_cores, backend="threading") as parallel:
+                similarity_matrix_rows = parallel(
+                    delayed(rbf_for_row)(sym_graph, self.ad.obsm[self.build_on], median_distances, i) for i in
+                    tqdm(range(self.n), disable=not self.verbose))
+
+            if self.verbose:
+                print("Building similarity LIL matrix...")
+
+            similarity_matrix = lil_matrix((self.n, self.n))
+            for i in tqdm(range(self.n), disable=not self.verbose):
+                similarity_matrix[i] = similarity_matrix_rows[i]
+
+            if self.verbose:
+                print("Constructing CSR matrix...")
+
+            self.M = (similarity_matrix).tocsr()
+            self.K = self.M @ self.M.T
+        return self.K
+
+    def add_points(self, ad):
+        """
+        Insert points appended to the data into the existing kNN graph and kernel. Only the neighbor lists and
+        bandwidths of points which gain a new point as one of their nearest neighbors are updated, and only the rows
+        of the similarity and kernel matrices which depend on them are recomputed.
+
+        :param ad: (anndata.AnnData) object containing the points used to build the kernel followed by the new points
+        :return: (sparse matrix) updated RBF kernel
+        """
+        with self.monitor.phase('add_points', n_points=ad.shape[0] - self.n):
+            return self._add_points(ad)
+
+    def _add_points(self, ad):
+        """
+        See add_points()
+        """
+        from sklearn.neighbors import NearestNeighbors
+
+        if self.M is None:
+            raise ValueError('Kernel has not been computed. Run rbf() first.')
+
+        data = ad.obsm[self.build_on]
+        n_old = self.n
+        n = data.shape[0]
+        n_new = n - n_old
+        n_nbrs = self.k - 1  # scanpy kNN graph excludes self
+
         if self.verbose:
-            print("Making graph symmetric...")
-        sym_graph = (knn_graph + knn_graph.T > 0).astype(float)
+            print("Updating kNN graph...")
+
+        # Neighbors of new points amongst old and new points
+        old_dists, old_nbrs = self._kneighbors(data[n_old:], min(n_nbrs, n_old))
+        new_index = NearestNeighbors().fit(data[n_old:])
+        new_dists, new_nbrs = new_index.kneighbors(data[n_old:], min(n_nbrs + 1, n_new))
+        # drop self
+        new_dists, new_nbrs = new_dists[:, 1:], new_nbrs[:, 1:] + n_old
+        new_rows_dists, new_rows_nbrs = _nearest_columns(np.hstack([old_dists, new_dists]),
+                                                         np.hstack([old_nbrs, new_nbrs]), n_nbrs)
+
+        # Old points with a new point closer than their current kth neighbor
+        closest_dists, closest_nbrs = new_index.kneighbors(data[:n_old], min(n_nbrs, n_new))
+        kth_dists = np.asarray(self.knn_distances.max(axis=1).todense()).ravel()
+        affected = np.where(closest_dists[:, 0] < kth_dists)[0]
+
+        cur_dists, cur_nbrs = _csr_rows_to_padded(self.knn_distances, affected)
+        aff_dists, aff_nbrs = _nearest_columns(np.hstack([cur_dists, closest_dists[affected]]),
+                                               np.hstack([cur_nbrs, closest_nbrs[affected] + n_old]), n_nbrs)
+
+        changed = np.concatenate([affected, np.arange(n_old, n)])
+        changed_rows = _padded_to_csr(np.vstack([aff_dists, new_rows_dists]),
+                                      np.vstack([aff_nbrs, new_rows_nbrs]), n)
+        knn_graph_distances = _replace_rows(self.knn_distances, changed, changed_rows, (n, n))
 
         if self.verbose:
-            print("Computing RBF kernel...")
+            print("Updating radius for adaptive bandwidth kernel...")
 
-        with Parallel(n_jobs=self.num_cores, backend="threading") as parallel:
-            similarity_matrix_rows = parallel(
-                delayed(rbf_for_row)(sym_graph, self.ad.obsm[self.build_on], median_distances, i) for i in
-                tqdm(range(self.n)))
+        median_distances = np.zeros(n)
+        median_distances[:n_old] = self.median_distances
+        nonzero_dists, _ = _csr_rows_to_padded(changed_rows, np.arange(len(changed)))
+        nonzero_dists = np.hstack([nonzero_dists, np.full((len(changed), self.k), np.inf)])
+        median_distances[changed] = np.sort(nonzero_dists, axis=1)[:, self.k // 2 - 1]
 
-        if self.verbose:
-            print("Building similarity LIL matrix...")
+        knn_graph = knn_graph_distances.copy()
+        knn_graph[knn_graph != 0] = 1
+        knn_graph.setdiag(1)
+        sym_graph = (knn_graph + knn_graph.T > 0).astype(float)
 
-        similarity_matrix = lil_matrix((self.n, self.n))
-        for i in tqdm(range(self.n)):
-            similarity_matrix[i] = similarity_matrix_rows[i]
+        if self.verbose:
+            print("Updating RBF kernel...")
+
+        old_sym_graph = self.sym_graph.copy()
+        old_sym_graph.resize((n, n))
+
+        # Similarity rows depending on the changed points, and kernel rows depending on those
+        indicator = np.zeros(n)
+        indicator[changed] = 1
+        support = sym_graph + old_sym_graph
+        M_rows = np.where((support @ indicator) + indicator > 0)[0]
+        indicator[M_rows] = 1
+        K_rows = np.where((support @ indicator) + indicator > 0)[0]
+
+        sub_graph = sym_graph[M_rows].tocoo()
+        rows, cols = M_rows[sub_graph.row], sub_graph.col
+        numerator = np.sum(np.square(data[rows, :] - data[cols, :]), axis=1)
+        denominator = median_distances[rows] * median_distances[cols]
+        similarity_rows = csr_matrix((np.exp(-numerator / denominator), (sub_graph.row, cols)),
+                                     shape=(len(M_rows), n))
+        M = _replace_rows(self.M, M_rows, similarity_rows, (n, n))
+
+        # M is symmetric, so M[rows] @ M.T == M[rows] @ M
+        K = _replace_rows(self.K, K_rows, M[K_rows] @ M, (n, n))
+
+        # Update model
+        self.n = n
+        self.indices = np.array(range(self.n))
+        self.ad = ad
+        self.median_distances = median_distances
+        self.knn_distances = knn_graph_distances
+        self.sym_graph = sym_graph
+        self.nn_index = None
+        self.M = M
+        self.K = K
+        ad.obsp['distances'] = knn_graph_distances
 
         if self.verbose:
-            print("Constructing CSR matrix...")
+            print(f"Updated {len(affected)} existing neighborhoods and {len(K_rows)} kernel rows.")
+
+        return self.K
+
+    def _kneighbors(self, X, n_neighbors):
+        """
+        Query the nearest neighbors of points X amongst the points used to build the kernel
+
+        :param X: (array) n_points x d matrix in the same space as the kernel
+        :param n_neighbors: (int) number of neighbors to return
+        :return: (array, array) distances and indices of the nearest neighbors
+        """
+        if self.nn_index is None:
+            from sklearn.neighbors import NearestNeighbors
+            self.nn_index = NearestNeighbors().fit(self.ad.obsm[self.build_on])
+        return self.nn_index.kneighbors(X, n_neighbors)
 
-        self.M = (similarity_matrix).tocsr()
-        return self.M @ self.M.T
+    def rbf_rows(self, X):
+        """
+        Compute rows of the adaptive bandwidth RBF similarity matrix for points that were not used to build
+        the kernel. Bandwidths of new points are computed as in rbf(), bandwidths of the original points are reused.
+
+        :param X: (array) n_points x d matrix in the same space as the kernel
+        :return: (sparse matrix) n_points x n similarity matrix
+        """
+        if self.M is None:
+            raise ValueError('Kernel has not been computed. Run rbf() first.')
+
+        distances, neighbors = self._kneighbors(X, self.k)
+        radii = distances[:, self.k // 2 - 1]
 
+        numerator = np.square(distances)
+        denominator = radii.reshape(-1, 1) * self.median_distances[neighbors]
+        values = np.exp(-numerator / denominator)
 
+        rows = np.repeat(np.arange(X.shape[0]), self.k)
+        return csr_matrix((values.ravel(), (rows, neighbors.ravel())), shape=(X.shape[0], self.n))
+
+    def kernel_rows(self, X):
+        """
+        Compute rows of the kernel returned by rbf() between new points X and the points used to build the kernel.
+
+        :param X: (array) n_points x d matrix in the same space as the kernel
+        :return: (sparse matrix) n_points x n kernel matrix
+        """
+        # M is symmetric, so M_X @ M.T == M_X @ M
+        return self.rbf_rows(X) @ self.M
@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse
+
+
+def background_peaks(ad, n_iterations=50, n_neighbors=100, gc_key='GC', random_state=0):
+    """
+    Sample background peaks matched to each peak on GC content and accessibility, as in chromVAR.
+
+    Peaks are embedded by their GC content and log total counts, and the embedding is whitened so that both
+    covariates have unit variance and are uncorrelated. For each peak, n_iterations background peaks are sampled
+    with replacement from its n_neighbors nearest peaks in the whitened embedding.
+
+    :param ad: (AnnData) cells x peaks counts with GC content of each peak in ad.var[gc_key]
+    :param n_iterations: (int) number of background peaks per peak
+    :param n_neighbors: (int) number of most similar peaks from which background peaks are sampled
+    :param gc_key: (str) column of ad.var with GC content
+    :param random_state: (int) seed of the random number generator
+    :return: (array) n_peaks x n_iterations indices of background peaks
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    if gc_key not in ad.var:
+        raise ValueError(f'GC content of peaks is required in ad.var["{gc_key}"].')
+
+    counts = np.ravel(ad.X.sum(axis=0))
+    if np.any(counts <= 0):
+        raise ValueError('Peaks without counts must be removed before sampling background peaks.')
+
+    # Whitened GC content and accessibility
+    covariates = np.column_stack([np.log10(counts), ad.var[gc_key].values.astype(float)])
+    covariates = covariates - covariates.mean(axis=0)
+    eigvals, eigvecs = np.linalg.eigh(np.cov(covariates, rowvar=False))
+    covariates = covariates @ eigvecs / np.sqrt(np.maximum(eigvals, np.finfo(float).eps))
+
+    n_neighbors = min(n_neighbors, ad.shape[1] - 1)
+    nbrs = NearestNeighbors(n_neighbors=n_neighbors).fit(covariates).kneighbors(return_distance=False)
+
+    rng = np.random.default_rng(random_state)
+    choice = rng.integers(0, n_neighbors, size=(ad.shape[1], n_iterations))
+    return np.take_along_axis(nbrs, choice, axis=1)
+
+
+def _annotation_matrix(annotations, peaks, annotation_names=None):
+    """
+    Sparse peaks x annotations matrix of peak annotations, e.g. motif matches.
+
+    :return: (1) (sparse matrix) n_peaks x n_annotations CSC matrix and (2) pd.Index of annotations
+    """
+    if isinstance(annotations, pd.DataFrame):
+        annotation_names = annotations.columns
+        annotations = annotations.reindex(peaks)
+        if annotations.isna().values.any():
+            raise ValueError('Annotations must be provided for all peaks.')
+        annotations = csr_matrix(annotations.values.astype(float))
+    else:
+        if annotations.shape[0] != len(peaks):
+            raise ValueError(f'Annotations have {annotations.shape[0]} rows, expected one per peak ({len(peaks)}).')
+        if annotation_names is None:
+            annotation_names = np.arange(annotations.shape[1])
+        annotations = csr_matrix(annotations, dtype=float)
+
+    return annotations.tocsc(), pd.Index(annotation_names)
+
+
+def _raw_deviations(X, depth, expected, annotations):
+    """
+    Relative deviations of observed counts of each annotation in each cell from counts expected from the
+    cell's depth and the fraction of all fragments in annotated peaks.
+
+    :param X: (sparse matrix) n_cells x n_peaks counts
+    :param depth: (array) total counts of each cell
+    :param expected: (array) fraction of all counts in each peak
+    :param annotations: (sparse matrix) n_peaks x n_annotations matrix of peak annotations
+    :return: (array) n_cells x n_annotations deviations
+    """
+    observed = X @ annotations
+    observed = observed.toarray() if issparse(observed) else np.asarray(observed)
+    expected = np.outer(depth, annotations.T @ expected)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (observed - expected) / expected
+
+
+def compute_deviations(ad, annotations, annotation_names=None, n_iterations=50, n_neighbors=100, gc_key='GC',
+                       n_jobs=1, random_state=0):
+    """
+    Compute chromVAR deviations of accessibility of annotated peaks, e.g. peaks with matches to each motif,
+    without densifying counts.
+
+    For each cell and annotation, the raw deviation is the relative difference between the observed counts in
+    annotated peaks and the counts expected from the cell's depth. Deviations are corrected for technical bias
+    by subtracting the mean deviation of background peak sets, in which each annotated peak is replaced with a
+    peak of similar GC content and accessibility (see background_peaks). Deviation scores (z-scores) are the
+    corrected deviations divided by the standard deviation of background deviations.
+
+    :param ad: (AnnData) cells x peaks counts, e.g. of metacells, with GC content of each peak in ad.var[gc_key]
+    :param annotations: (pd.DataFrame or sparse matrix) peaks x annotations binary matrix of motif matches.
+                        DataFrames are indexed by peak; matrices are in the order of ad.var_names.
+    :param annotation_names: (list) names of annotations, if annotations is a matrix
+    :param n_iterations: (int) number of background peak sets, at least 2
+    :param n_neighbors: (int) number of most similar peaks from which background peaks are sampled
+    :param gc_key: (str) column of ad.var with GC content
+    :param n_jobs: (int) number of threads used to compute background deviations
+    :param random_state: (int) seed for sampling background peaks
+    :return: (1) pd.DataFrame of bias-corrected deviations and (2) pd.DataFrame of deviation scores,
+             both cells x annotations
+    """
+    from joblib import Parallel, delayed, effective_n_jobs
+
+    if n_iterations < 2:
+        raise ValueError('At least 2 background iterations are required to estimate the variance of deviations.')
+
+    annotations, annotation_names = _annotation_matrix(annotations, ad.var_names, annotation_names)
+
+    # Drop peaks without counts
+    counts = np.ravel(ad.X.sum(axis=0))
+    keep = np.where(counts > 0)[0]
+    if len(keep) < ad.shape[1]:
+        ad = ad[:, keep]
+        annotations = annotations[keep]
+    X = csr_matrix(ad.X, dtype=float)
+    depth = np.ravel(X.sum(axis=1))
+    expected = np.ravel(X.sum(axis=0)) / X.sum()
+
+    raw = _raw_deviations(X, depth, expected, annotations)
+
+    # Background annotations: annotated peaks replaced with their background peaks
+    background = background_peaks(ad, n_iterations, n_neighbors, gc_key, random_state)
+    n_peaks = X.shape[1]
+
+    def _background_deviations(i):
+        replace = csr_matrix((np.ones(n_peaks), (background[:, i], np.arange(n_peaks))), shape=(n_peaks, n_peaks))
+        return _raw_deviations(X, depth, expected, (replace @ annotations).tocsc())
+
+    # Running mean and sum of squared differences from the mean (Welford) of background deviations, accumulated
+    # over blocks of iterations
+    bg_mean = np.zeros(raw.shape)
+    bg_sq_diff = np.zeros(raw.shape)
+    count = 0
+    block = effective_n_jobs(n_jobs)
+    with Parallel(n_jobs=n_jobs, prefer='threads') as parallel:
+        for start in range(0, n_iterations, block):
+            for deviations in parallel(delayed(_background_deviations)(i)
+                                       for i in range(start, min(start + block, n_iterations))):
+                count += 1
+                delta = deviations - bg_mean
+                bg_mean += delta / count
+                bg_sq_diff += delta * (deviations - bg_mean)
+
+    bg_sd = np.sqrt(bg_sq_diff / (n_iterations - 1))
+
+    corrected = raw - bg_mean
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = corrected / bg_sd
+
+    deviations = pd.DataFrame(corrected, index=ad.obs_names, columns=annotation_names)
+    deviation_scores = pd.DataFrame(scores, index=ad.obs_names, columns=annotation_names)
+    return deviations, deviation_scores
+
+
+def compute_variability(deviation_scores):
+    """
+    Variability of each annotation across cells, as the standard deviation of its deviation scores, with
+    p-values from a chi-squared test of the variance of scores against unit variance (as in chromVAR).
+
+    :param deviation_scores: (pd.DataFrame) cells x annotations deviation scores (see compute_deviations)
+    :return: pd.DataFrame with variability, p-value and Benjamini-Hochberg adjusted p-value of each annotation
+    """
+    from scipy.stats import chi2
+
+    scores = deviation_scores.values
+    n = np.sum(~np.isnan(scores), axis=0)
+    variability = np.nanstd(scores, axis=0, ddof=1)
+    p_value = chi2.sf((n - 1) * variability ** 2, n - 1)
+
+    # Benjamini-Hochberg adjustment over annotations with p-values
+    tested = np.where(~np.isnan(p_value))[0]
+    order = tested[np.argsort(p_value[tested])]
+    ranked = p_value[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted = np.full(len(p_value), np.nan)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+
+    return pd.DataFrame({'variability': variability, 'p_value': p_value, 'p_value_adj': adjusted},
+                        index=deviation_scores.columns)
@@ -1,9 +1,13 @@
+from contextlib import contextmanager
+
 import numpy as np
 import pandas as pd
-import palantir
-from tqdm.notebook import tqdm
+from scipy.sparse import csr_matrix, diags, vstack
+from tqdm.auto import tqdm
 
 from . import build_graph
+from .diffusion import diffusion_components
+from .instrument import FitMonitor
 
 
 class SEACells:
@@ -24,7 +28,10 @@ class SEACells:
                  n_waypoint_eigs: int = 10,
                  waypt_proportion: float = 1,
                  n_neighbors: int = 15,
-                 convergence_epsilon=1e-5):
+                 convergence_epsilon=1e-5,
+                 convergence_assignment_fraction: float = None,
+                 n_workers: int = 1,
+                 monitor=None):
         """
 
         :param ad: AnnData object containing observations matrix to use for computing SEACells
@@ -38,6 +45,13 @@ class SEACells:
         :param waypt_proportion: (float) proportion of SEACells to initialize using waypoint method, remainder using greedy
         :param n_neighbors: (int) number of neighbors to use in building kNN graph
         :param convergence_epsilon: (float) stop optimizing when squared error is below this proportion of its original value
+        :param convergence_assignment_fraction: (float) if specified, stop optimizing when the fraction of cells which
+                        change SEACell in an iteration is below this value, instead of using convergence_epsilon
+        :param n_workers: (int) number of local worker processes used to update A and B. If 1, updates are computed
+                        in the current process. Workers are spawned, so scripts using them must guard their entry
+                        point with if __name__ == '__main__'.
+        :param monitor: (instrument.FitMonitor) records time and memory of each phase of fitting and statistics of each
+                        iteration, and can stop fitting early through its callback. If None, a new monitor is created.
         """
 
         self.ad = ad
@@ -59,6 +73,19 @@ class SEACells:
         self.RSS_iters = []
         self.convergence_epsilon = convergence_epsilon
         self.convergence_threshold = None
+        self.convergence_assignment_fraction = convergence_assignment_fraction
+
+        self.n_workers = n_workers
+        self._cluster = None
+
+        self.monitor = monitor if monitor is not None else FitMonitor()
+
+        self.kernel_model = None
+        self._BtKB = None
+
+        # number of inner iterations run by the last A and B updates
+        self._A_iterations = 0
+        self._B_iterations = 0
 
         print
 
@@ -73,7 +100,8 @@ class SEACells:
         k = self.k
 
         if self.waypoint_proportion > 0:
-            waypt_ix = self._get_waypoint_centers(k)
+            with self.monitor.phase('waypoint_initialization'):
+                waypt_ix = self._get_waypoint_centers(k)
             waypt_ix = np.random.choice(waypt_ix, int(len(waypt_ix) * self.waypoint_proportion), replace=False)
             from_greedy = self.k - len(waypt_ix)
             if self.verbose:
@@ -82,7 +110,8 @@ class SEACells:
         else:
             from_greedy = self.k
 
-        greedy_ix = self._get_greedy_centers(n_mcs=from_greedy + 10)
+        with self.monitor.phase('greedy_initialization'):
+            greedy_ix = self._get_greedy_centers(n_mcs=from_greedy + 10)
         if self.verbose:
             print(f'Selecting {from_greedy} cells from greedy initialization.')
 
@@ -117,27 +146,20 @@ class SEACells:
 
         ad = self.ad
 
-        if self.build_kernel_on == 'X_pca':
-            pca_components = pd.DataFrame(ad.obsm['X_pca']).set_index(ad.obs_names)
-        elif self.build_kernel_on == 'X_svd':
-            # Compute PCA components from ad object
-            pca_components = pd.DataFrame(ad.obsm['X_svd']).set_index(ad.obs_names)
-        else:
-            pca_components = pd.DataFrame(ad.obsm[self.build_kernel_on]).set_index(ad.obs_names)
-
-        print(f'Building kernel on {self.build_kernel_on}')
-
         if self.verbose:
+            print(f'Building kernel on {self.build_kernel_on}')
+
             print(f'Computing diffusion components from {self.build_kernel_on} for waypoint initialization ... ')
 
-        dm_res = palantir.utils.run_diffusion_maps(pca_components, n_components=self.n_neighbors)
-        dc_components = palantir.utils.determine_multiscale_space(dm_res, n_eigs=self.n_waypoint_eigs)
+        dc_components = diffusion_components(ad, self.build_kernel_on, n_eigs=self.n_waypoint_eigs,
+                                             n_components=self.n_neighbors)
         if self.verbose:
             print('Done.')
 
         # Initialize SEACells via waypoint sampling
         if self.verbose:
             print('Sampling waypoints ...')
+        import palantir
         waypoint_init = palantir.core._max_min_sampling(data=dc_components, num_waypoints=k)
         dc_components['iix'] = np.arange(len(dc_components))
         waypt_ix = dc_components.loc[waypoint_init]['iix'].values
@@ -146,12 +168,15 @@ class SEACells:
 
         return waypt_ix
 
-    def _get_greedy_centers(self, n_mcs=None):
+    def _get_greedy_centers(self, n_mcs=None, fixed_centers=None, candidates=None):
         """Initialize SEACells using fast greedy adaptive CSSP
 
         From https://arxiv.org/pdf/1312.6838.pdf
         :param n_mcs: (int) number of SEACells to initialize using greedy selection. If None specified,
                         all SEACells initialized using this method.
+        :param fixed_centers: (array) indices of cells that are selected before the greedy selection starts, so that
+                        new centers are selected on the residual of these cells. Not included in the output.
+        :param candidates: (array) indices of cells that may be selected. If None, all cells are candidates.
         :return: B - (array) n_datapoints x n_SEACells matrix with initial SEACell definitions
         """
 
@@ -163,6 +188,17 @@ class SEACells:
         else:
             k = n_mcs
 
+        if fixed_centers is None:
+            fixed_centers = np.array([], dtype=int)
+        n_fixed = len(fixed_centers)
+        k = k + n_fixed
+
+        if candidates is None:
+            mask = np.zeros(n)
+        else:
+            mask = np.full(n, -np.inf)
+            mask[candidates] = 0
+
         X = K
 
         if self.verbose:
@@ -186,10 +222,13 @@ class SEACells:
         centers = np.zeros(k, dtype=int)
 
         # sampling
-        for j in tqdm(range(k)):
+        for j in tqdm(range(k), disable=not self.verbose):
 
-            score = f / g
-            p = np.argmax(score)
+            if j < n_fixed:
+                p = fixed_centers[j]
+            else:
+                score = f / g + mask
+                p = np.argmax(score)
 
             # print residuals
             residual = np.sum(f)
@@ -229,7 +268,7 @@ class SEACells:
             # add index
             centers[j] = int(p)
 
-        return centers
+        return centers[n_fixed:]
 
     def _updateA(self, B, A_prev):
         """
@@ -238,16 +277,33 @@ class SEACells:
         :param B: (array) n*k matrix (dense) defining SEACells as weighted combinations of cells
         :return: A: (array) k*n matrix (dense) defining weights used for assigning cells to SEACells
         """
-        n, k = B.shape
-
-        A = A_prev
-
-        t = 0  # current iteration (determine multiplicative update)
+        if self._cluster is not None:
+            A = self._cluster.updateA(B, A_prev)
+            self._A_iterations = self._cluster.A_iterations
+            return A
 
         # precompute some gradient terms
         t2 = (self.K @ B).T
         t1 = t2 @ B
 
+        return self._solveA(t1, t2, A_prev)
+
+    def _solveA(self, t1, t2, A_prev):
+        """
+        Solve the assignment subproblem for each cell (column of A) using the Frank-Wolfe algorithm.
+        Columns are independent of each other given the gradient terms.
+
+        :param t1: (array) k*k matrix B.T @ K @ B
+        :param t2: (array) k*n matrix (K @ B).T restricted to the cells being assigned
+        :param A_prev: (array) k*n matrix (dense) initial assignments
+        :return: A: (array) k*n matrix (dense) defining weights used for assigning cells to SEACells
+        """
+        k, n = t2.shape
+
+        A = A_prev
+
+        t = 0  # current iteration (determine multiplicative update)
+
         # update rows of A for given number of iterations
         while t < self.max_iter:
             # compute gradient (must convert matrix to ndarray)
@@ -263,6 +319,7 @@ class SEACells:
             A += 2. / (t + 2.) * (e - A)
             t += 1
 
+        self._A_iterations = t
         return A
 
     def _updateB(self, A, B_prev):
@@ -272,6 +329,10 @@ class SEACells:
         :param A: (array) k*n matrix (dense) defining weights used for assigning cells to SEACells
         :return: B: (array) n*k matrix (dense) defining SEACells as weighted combinations of cells
         """
+        if self._cluster is not None:
+            B = self._cluster.updateB(A, B_prev)
+            self._B_iterations = self._cluster.B_iterations
+            return B
 
         K = self.K
         k, n = A.shape
@@ -300,6 +361,7 @@ class SEACells:
 
             t += 1
 
+        self._B_iterations = t
         return B
 
     def compute_reconstruction(self, A=None, B=None):
@@ -373,11 +435,14 @@ class SEACells:
             print('Building kernel...')
 
         # input to graph construction is PCA/SVD
-        kernel_model = build_graph.SEACellGraph(self.ad, self.build_kernel_on, verbose=True)
+        kernel_model = build_graph.SEACellGraph(self.ad, self.build_kernel_on, verbose=self.verbose,
+                                                monitor=self.monitor)
 
         # K is a sparse matrix representing input to SEACell alg
         K = kernel_model.rbf(self.n_neighbors)
         self.K = K
+        self.kernel_model = kernel_model
+        self._BtKB = None
 
         # initialize B (update this to allow initialization from RRQR)
         n = K.shape[0]
@@ -399,12 +464,48 @@ class SEACells:
 
         A = np.random.random((k, n))
         A /= A.sum(0)
-        A = self._updateA(B, A)
-        
-        print('Randomly initialized A matrix.')
+
+        with self._workers():
+            with self.monitor.phase('updateA', iteration=0):
+                A = self._updateA(B, A)
+
+            if self.verbose:
+                print('Randomly initialized A matrix.')
+
+            self._optimize(A, B, max_iter, min_iter)
+
+    @contextmanager
+    def _workers(self):
+        """
+        Context in which A and B updates are distributed over n_workers local worker processes
+        """
+        if self.n_workers > 1:
+            from .distributed import LocalCluster
+            if self.verbose:
+                print(f'Starting {self.n_workers} workers...')
+            self._cluster = LocalCluster(self.K, self.n_workers, self.max_iter)
+        try:
+            yield
+        finally:
+            if self._cluster is not None:
+                self._cluster.close()
+                self._cluster = None
+
+    def _optimize(self, A, B, max_iter: int = 50, min_iter: int = 10):
+        """
+        Iteratively update A and B matrices until maximum number of iterations or convergence has been achieved.
+
+        Modifies ad.obs in place to add 'SEACell' labels to cells.
+
+        :param A: (array) k*n matrix (dense) initial assignments
+        :param B: (array) n*k matrix (dense) initial archetypes
+        :param max_iter: (int) maximum number of iterations to update A and B matrices
+        :param min_iter: (int) minimum number of iterations to update A and B matrices
+        """
 
         # Create convergence threshold
-        RSS = self.compute_RSS(A, B)
+        with self.monitor.phase('RSS', iteration=0):
+            RSS = self.compute_RSS(A, B)
         self.RSS_iters.append(RSS)
 
         if self.convergence_threshold is None:
@@ -412,47 +513,131 @@ class SEACells:
             if self.verbose:
                 print(f'Setting convergence threshold at {self.convergence_threshold}')
 
+        labels = np.argmax(A, axis=0)
+
         converged = False
+        stop = False
         n_iter = 0
-        while (not converged and n_iter < max_iter) or n_iter < min_iter:
+        while not stop and ((not converged and n_iter < max_iter) or n_iter < min_iter):
 
             n_iter += 1
 
-            if n_iter == 1 or (n_iter) % 10 == 0:
+            if self.verbose and (n_iter == 1 or (n_iter) % 10 == 0):
                 print(f"Starting iteration {n_iter}.")
-            if self.true_A is None:
-                A = self._updateA(B, A)
-            else:
-                print('Not updating A, true A provided')
-                A = self.true_A
-
-            if self.true_B is None:
-                B = self._updateB(A, B)
-            else:
-                print('Not updating B, true B provided')
-
-            if n_iter == 1 or (n_iter) % 10 == 0:
+            with self.monitor.phase('updateA', iteration=n_iter):
+                if self.true_A is None:
+                    A = self._updateA(B, A)
+                    A_iterations = self._A_iterations
+                else:
+                    if self.verbose:
+                        print('Not updating A, true A provided')
+                    A = self.true_A
+                    A_iterations = 0
+
+            with self.monitor.phase('updateB', iteration=n_iter):
+                if self.true_B is None:
+                    B = self._updateB(A, B)
+                    B_iterations = self._B_iterations
+                else:
+                    if self.verbose:
+                        print('Not updating B, true B provided')
+                    B_iterations = 0
+
+            if self.verbose and (n_iter == 1 or (n_iter) % 10 == 0):
                 print(f"Completed iteration {n_iter}.")
 
-            self.RSS_iters.append(self.compute_RSS(A, B))
+            with self.monitor.phase('RSS', iteration=n_iter):
+                self.RSS_iters.append(self.compute_RSS(A, B))
+
+            # Number of cells which changed SEACell
+            new_labels = np.argmax(A, axis=0)
+            n_changed = int(np.sum(new_labels != labels))
+            labels = new_labels
 
             # Check for convergence
-            if np.abs(self.RSS_iters[-2] - self.RSS_iters[-1]) < self.convergence_threshold:
+            if self.convergence_assignment_fraction is not None:
+                if n_changed < self.convergence_assignment_fraction * len(labels):
+                    converged = True
+            elif np.abs(self.RSS_iters[-2] - self.RSS_iters[-1]) < self.convergence_threshold:
                 converged = True
 
-            self.A_ = A
-            self.B_ = B
-            n_SEACells = self.get_assignments()['SEACell'].unique().shape[0]
+            stop = self.monitor.iteration(iteration=n_iter,
+                                          RSS=self.RSS_iters[-1],
+                                          A_iterations=A_iterations,
+                                          B_iterations=B_iterations,
+                                          assignment_changes=n_changed,
+                                          converged=converged)
 
-        print(f'Converged after {n_iter} iterations.')
+        if self.verbose:
+            if stop:
+                print(f'Stopped by callback after {n_iter} iterations.')
+            else:
+                print(f'Converged after {n_iter} iterations.')
         self.A_ = A
         self.B_ = B
         self.Z_ = B.T @ self.K
+        self._BtKB = None
 
         # Label SEACells as well as assignment entropy as proxy for SEACell 'confidence'
         labels = self.get_assignments()
         self.ad.obs['SEACell'] = labels['SEACell']
 
+    def fit_incremental(self, ad, n_new_SEACells: int = None, max_iter: int = 10, min_iter: int = 2):
+        """
+        Update a fitted model after new cells have been appended to the dataset. The new cells are inserted into the
+        existing kNN graph and kernel, new SEACells are selected amongst the new cells by greedy selection on the
+        residual of the current SEACells, and A and B are warm-started from the previous solution.
+
+        Modifies ad.obs in place to add 'SEACell' labels to cells.
+
+        :param ad: AnnData object containing the cells used for fitting followed by the new cells
+        :param n_new_SEACells: (int) number of SEACells to add. If None, SEACells are added in proportion to the
+                        number of new cells.
+        :param max_iter: (int) maximum number of iterations to update A and B matrices
+        :param min_iter: (int) minimum number of iterations to update A and B matrices
+        """
+        if self.kernel_model is None:
+            raise ValueError('Model has not been fitted. Run fit() first.')
+        if self.true_A is not None or self.true_B is not None:
+            raise ValueError('Incremental fitting is not supported with a fixed A or B matrix.')
+
+        n_old = self.K.shape[0]
+        if ad.shape[0] < n_old or not ad.obs_names[:n_old].equals(self.ad.obs_names):
+            raise ValueError('AnnData must contain the cells used for fitting followed by the new cells.')
+        if self.build_kernel_on not in ad.obsm:
+            raise ValueError(f'Key {self.build_kernel_on} is not present in AnnData obsm.')
+
+        n = ad.shape[0]
+        k_old = self.k
+        if n_new_SEACells is None:
+            n_new_SEACells = int(np.round(k_old * (n - n_old) / n_old))
+
+        if self.verbose:
+            print(f'Adding {n - n_old} cells to kernel...')
+        self.K = self.kernel_model.add_points(ad)
+        self.ad = ad
+
+        # Warm start from the previous solution
+        B = np.zeros((n, k_old + n_new_SEACells))
+        B[:n_old, :k_old] = self.B_
+        if n_new_SEACells > 0:
+            if self.verbose:
+                print(f'Selecting {n_new_SEACells} cells from greedy initialization.')
+            with self.monitor.phase('greedy_initialization'):
+                # SEACells may share a center, which must only be fixed once
+                new_ix = self._get_greedy_centers(n_mcs=n_new_SEACells,
+                                                  fixed_centers=np.unique(self.get_centers()),
+                                                  candidates=np.arange(n_old, n))
+            B[new_ix, np.arange(k_old, k_old + n_new_SEACells)] = 1
+
+        A = np.zeros((k_old + n_new_SEACells, n))
+        A[:k_old, :n_old] = self.A_
+        A[:, n_old:] = 1. / A.shape[0]
+
+        self.k = k_old + n_new_SEACells
+        self.convergence_threshold = None
+        with self._workers():
+            self._optimize(A, B, max_iter, min_iter)
 
     def fit(self, n_iter: int = 8, waypoint_proportion: float = None, B0=None):
         """
@@ -467,6 +652,54 @@ class SEACells:
             self.waypoint_proportion = waypoint_proportion
         self._fit(n_iter, B0=B0)
 
+    def transform(self, X):
+        """
+        Assign new cells to the fitted SEACells without refitting. Kernel rows between the new cells and the cells
+        used for fitting are computed using the stored bandwidths and neighbor index, and the assignment
+        subproblem is solved for each new cell against the fixed archetype matrix B. Cells of an AnnData object
+        which were used for fitting, with the same name and embedding, are assigned using their rows of the
+        fitted kernel.
+
+        :param X: AnnData object containing build_kernel_on in .obsm, or (array) n_new x d matrix in the
+                same embedding space used for fitting
+        :return: (1) pd.DataFrame with column 'SEACell' containing hard assignments of the new cells and
+                 (2) (array) n_new x n_SEACells matrix of soft assignments
+        """
+        if self.kernel_model is None:
+            raise ValueError('Model has not been fitted. Run fit() first.')
+
+        if hasattr(X, 'obsm'):
+            index = X.obs_names
+            X = np.asarray(X.obsm[self.build_kernel_on])
+            cells = self.ad.obs_names.get_indexer(index)
+            fitted = cells >= 0
+            fitted[fitted] = np.all(X[fitted] == np.asarray(self.ad.obsm[self.build_kernel_on])[cells[fitted]], axis=1)
+        else:
+            index = pd.RangeIndex(X.shape[0])
+            X = np.asarray(X)
+            fitted = np.zeros(X.shape[0], dtype=bool)
+
+        B = self.B_
+        if self._BtKB is None:
+            self._BtKB = self.Z_ @ B
+
+        if np.all(fitted):
+            K_new = self.K[cells]
+        elif np.any(fitted):
+            order = np.concatenate([np.where(fitted)[0], np.where(~fitted)[0]])
+            K_new = vstack([self.K[cells[fitted]], self.kernel_model.kernel_rows(X[~fitted])]).tocsr()
+            K_new = K_new[np.argsort(order)]
+        else:
+            K_new = self.kernel_model.kernel_rows(X)
+        t2 = np.asarray((K_new @ B).T)
+        A = self._solveA(self._BtKB, t2, np.zeros(t2.shape))
+
+        labels = self._get_SEACell_names()[np.argmax(A, axis=0)]
+        df = pd.DataFrame({'SEACell': labels}, index=index)
+        df.index.name = 'index'
+
+        return df, A.T
+
     def get_archetypes(self):
         """Return k x n matrix of archetypes"""
         return self.Z_
@@ -496,6 +729,16 @@ class SEACells:
         bin_T[np.argmax(T, axis=0), np.arange(T.shape[1])] = 1
         return bin_T.astype(int)
 
+    def _get_SEACell_names(self):
+        """
+        Name each SEACell after the cell at its center, following the labelling used by get_assignments().
+        :return: (array) of length n_SEACells containing cell names, NaN for SEACells without a center
+        """
+        centers = np.unique(np.argmax(self.B_, axis=0))
+        names = np.full(self.B_.shape[1], np.nan, dtype=object)
+        names[np.argmax(self.A_[:, centers], axis=0)] = np.asarray(self.ad.obs_names)[centers]
+        return names
+
     def get_assignments(self):
         """
         Returns a dataframe with SEACell assignments under the column 'SEACell'
@@ -503,50 +746,170 @@ class SEACells:
         """
 
         # Use argmax to get the index with the highest assignment weight
-        bin_A = self.binarize_matrix_rows(self.A_)
-        bin_B = self.binarize_matrix_rows(self.B_)
-
-        labels = np.dot(bin_A.T, np.arange(bin_A.shape[0]))
+        labels = self._get_SEACell_names()[np.argmax(self.A_, axis=0)]
 
-        df = pd.DataFrame({'SEACell': labels.astype(int), 'is_MC': bin_B.sum(1).astype(bool)})
-        df.index = self.ad.obs_names
+        df = pd.DataFrame({'SEACell': labels}, index=self.ad.obs_names)
         df.index.name = 'index'
-        di = df[df['is_MC'] == True]['SEACell'].reset_index().set_index('SEACell').to_dict()['index']
 
-        df['SEACell'] = df['SEACell'].map(di)
+        return df
+
 
-        return pd.DataFrame(df['SEACell'])
+def _get_layer(ad, layer):
+    """
+    Return data matrix and variable names of a layer of an AnnData object.
+    :param layer: (str) 'raw' for ad.raw.X (ad.layers['raw'] if ad.raw is not set), 'X' for ad.X, or key in ad.layers
+    """
+    if layer == 'raw' and ad.raw is not None:
+        return ad.raw.X, ad.raw.var_names
+    if layer == 'X':
+        return ad.X, ad.var_names
+    if layer not in ad.layers:
+        raise ValueError(f'Layer {layer} is not present in AnnData' +
+                         (' and AnnData has no raw data.' if layer == 'raw' else '.'))
+    return ad.layers[layer], ad.var_names
 
 
-def summarize_by_SEACell(ad, SEACells_label='SEACell', summarize_layer='raw'):
+def summarize_by_SEACell(ad, SEACells_label='SEACell', summarize_layer='raw', layers=None, mode='sum', model=None):
     """
     Aggregates cells within each SEACell, summing over all raw data for all cells belonging to a SEACell.
     Data is unnormalized and raw aggregated counts are stored .layers['raw'].
     Attributes associated with variables (.var) are copied over, but relevant per SEACell attributes must be
     manually copied, since certain attributes may need to be summed, or averaged etc, depending on the attribute.
     The output of this function is an anndata object of shape n_metacells x original_data_dimension.
+
+    Aggregation is computed as a product with a sparse SEACell x cell indicator matrix, so data stays sparse.
+
+    :param ad: AnnData object with SEACell assignments in ad.obs[SEACells_label]
+    :param SEACells_label: (str) column in ad.obs containing SEACell assignments
+    :param summarize_layer: (str) data aggregated into .X - 'raw' for ad.raw.X (ad.layers['raw'] if ad.raw is not
+                set), 'X' for ad.X, or a key in ad.layers
+    :param layers: (list) additional data aggregated into layers of the same name, specified as for summarize_layer
+    :param mode: (str) 'sum' to sum over the cells of each SEACell, or 'mean' to average them
+    :param model: (core.SEACells) fitted model. If provided, cells are weighted by their soft assignments to each
+                SEACell instead of being assigned to a single SEACell.
     :return: anndata.AnnData containing aggregated counts.
 
     """
-    from scipy.sparse import csr_matrix
     import scanpy as sc
+    from .aggregate import SEACell_indicator, aggregate
+
+    if model is None:
+        # Set of metacells
+        indicator, metacells = SEACell_indicator(ad.obs[SEACells_label])
+    else:
+        cells = model.ad.obs_names.get_indexer(ad.obs_names)
+        if np.any(cells < 0):
+            raise ValueError('All cells in AnnData must have been used to fit the model.')
+        names = model._get_SEACell_names()
+        keep = pd.notna(names)
+        indicator = model.A_[keep][:, cells]
+        metacells = pd.Index(names[keep])
+
+    X, var_names = _get_layer(ad, summarize_layer)
 
-    # Set of metacells
-    metacells = ad.obs[SEACells_label].unique()
+    # Ann data
+    # Counts
+    meta_ad = sc.AnnData(aggregate(X, indicator, mode))
+    meta_ad.obs_names, meta_ad.var_names = metacells.astype(str), var_names
 
-    # Summary matrix
-    summ_matrix = pd.DataFrame(0.0, index=metacells, columns=ad.var_names)
+    for layer in layers if layers is not None else []:
+        layer_X, layer_var_names = _get_layer(ad, layer)
+        if not layer_var_names.equals(var_names):
+            raise ValueError(f'Variables of layer {layer} do not match variables of {summarize_layer}.')
+        meta_ad.layers[layer] = aggregate(layer_X, indicator, mode)
 
-    for m in tqdm(summ_matrix.index):
-        cells = ad.obs_names[ad.obs[SEACells_label] == m]
-        if summarize_layer == 'raw' and ad.raw != None:
-            summ_matrix.loc[m, :] = np.ravel(ad[cells, :].raw.X.sum(axis=0))
-        else:
-            summ_matrix.loc[m, :] = np.ravel(ad[cells, :].layers[summarize_layer].sum(axis=0))
+    return meta_ad
 
-    # Ann data
-    # Counts
-    meta_ad = sc.AnnData(csr_matrix(summ_matrix))
-    meta_ad.obs_names, meta_ad.var_names = summ_matrix.index.astype(str), ad.var_names
 
+def _h5ad_reader():
+    """
+    Return functions for reading AnnData elements and backed sparse matrices from an open h5ad file
+    """
+    try:
+        from anndata.io import read_elem, sparse_dataset
+    except ImportError:
+        from anndata.experimental import read_elem, sparse_dataset
+    return read_elem, sparse_dataset
+
+
+def summarize_by_SEACell_on_disk(path, output_path, SEACells_label='SEACell', summarize_layer='raw', layers=None,
+                                 mode='sum', obs_columns=None, chunk_size: int = 10000):
+    """
+    Aggregates cells within each SEACell as summarize_by_SEACell(), reading data from an h5ad file in chunks of rows
+    instead of loading it in memory. Memory usage is bounded by the size of a chunk and of the aggregated data.
+
+    Cell annotations in obs_columns are aggregated as well: numeric columns are averaged and other columns are
+    summarized by their most frequent value. The aggregated AnnData is written to output_path.
+
+    :param path: (str) path to h5ad file with SEACell assignments in obs[SEACells_label]
+    :param output_path: (str) path to which the aggregated h5ad file is written
+    :param SEACells_label: (str) column in obs containing SEACell assignments
+    :param summarize_layer: (str) data aggregated into .X - 'raw' for raw.X (layers['raw'] if the file has no raw
+                data), 'X' for X, or a key in layers
+    :param layers: (list) additional data aggregated into layers of the same name, specified as for summarize_layer
+    :param mode: (str) 'sum' to sum over the cells of each SEACell, or 'mean' to average them
+    :param obs_columns: (list) columns of obs to aggregate. If None, no annotations are aggregated.
+    :param chunk_size: (int) number of cells read at a time
+    :return: anndata.AnnData containing aggregated counts.
+    """
+    import h5py
+    import anndata
+    from .aggregate import SEACell_indicator, aggregate_obs
+
+    if mode not in ('sum', 'mean'):
+        raise ValueError(f'Mode {mode} is not supported. Use "sum" or "mean".')
+
+    read_elem, sparse_dataset = _h5ad_reader()
+
+    with h5py.File(path, 'r') as f:
+        obs = read_elem(f['obs'])
+        var_names = read_elem(f['var']).index
+
+        def layer_key(layer):
+            if layer == 'raw' and 'raw' in f:
+                return 'raw/X', read_elem(f['raw/var']).index
+            if layer == 'X':
+                return 'X', var_names
+            if 'layers' not in f or layer not in f['layers']:
+                raise ValueError(f'Layer {layer} is not present in {path}' +
+                                 (' and the file has no raw data.' if layer == 'raw' else '.'))
+            return f'layers/{layer}', var_names
+
+        indicator, metacells = SEACell_indicator(obs[SEACells_label])
+        indicator = indicator.tocsc()
+        sizes = np.ravel(indicator.sum(axis=1))
+
+        summaries = {}
+        X_var_names = None
+        for layer in [summarize_layer] + (list(layers) if layers is not None else []):
+            key, layer_var_names = layer_key(layer)
+            if X_var_names is None:
+                X_var_names = layer_var_names
+            elif not layer_var_names.equals(X_var_names):
+                raise ValueError(f'Variables of layer {layer} do not match variables of {summarize_layer}.')
+
+            elem = f[key]
+            data = elem if isinstance(elem, h5py.Dataset) else sparse_dataset(elem)
+
+            total = None
+            for start in tqdm(range(0, obs.shape[0], chunk_size), desc=layer):
+                stop = min(start + chunk_size, obs.shape[0])
+                chunk = indicator[:, start:stop] @ data[start:stop]
+                total = chunk if total is None else total + chunk
+
+            if mode == 'mean':
+                total = diags(np.divide(1., sizes, out=np.zeros(len(sizes)), where=sizes != 0)) @ total
+            summaries[layer] = csr_matrix(total)
+
+    meta_ad = anndata.AnnData(summaries.pop(summarize_layer))
+    meta_ad.obs_names, meta_ad.var_names = metacells.astype(str), X_var_names
+    for layer, X in summaries.items():
+        meta_ad.layers[layer] = X
+
+    if obs_columns is not None:
+        meta_obs = aggregate_obs(obs, indicator, obs_columns)
+        meta_obs.index = meta_ad.obs_names
+        meta_ad.obs = meta_obs
+
+    meta_ad.write_h5ad(output_path)
     return meta_ad
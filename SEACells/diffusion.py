@@ -0,0 +1,58 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+def _embedding_fingerprint(X):
+    """SHA-1 digest of the values of an embedding, to detect changes of the embedding after caching"""
+    return hashlib.sha1(np.ascontiguousarray(X).view(np.uint8)).hexdigest()
+
+
+def diffusion_components(ad, low_dim_embedding, n_eigs=10, n_components=10, knn=30, use_cache=True):
+    """
+    Compute multiscale diffusion components of cells from a low-dimensional embedding, using palantir.
+
+    Diffusion maps are cached in the AnnData object, so that they are computed once for each embedding and number of
+    neighbors, and shared by SEACells initialization and evaluation. Eigenvectors are stored in
+    ad.obsm['DC_{low_dim_embedding}_{knn}'], and eigenvalues and parameters in ad.uns under the same key. Requests
+    for fewer components than are cached use the leading cached components. The cache is recomputed if the
+    embedding changes or more components are requested.
+
+    :param ad: (AnnData) annotated data matrix
+    :param low_dim_embedding: (str) key of ad.obsm with the embedding on which diffusion maps are computed
+    :param n_eigs: (int) number of eigenvectors of the multiscale space. If None, determined from the eigen gap.
+    :param n_components: (int) number of diffusion components
+    :param knn: (int) number of nearest neighbors of the diffusion kernel
+    :param use_cache: (bool) whether to read and write the cache
+    :return: pd.DataFrame of multiscale diffusion components, indexed by cell
+    """
+    import palantir
+
+    if low_dim_embedding not in ad.obsm:
+        raise ValueError(f'Key {low_dim_embedding} not present in ad.obsm.')
+
+    key = f'DC_{low_dim_embedding}_{knn}'
+    embedding = np.asarray(ad.obsm[low_dim_embedding])
+    fingerprint = _embedding_fingerprint(embedding)
+
+    cached = ad.uns.get(key) if use_cache else None
+    if cached is not None and key in ad.obsm and cached['embedding_fingerprint'] == fingerprint \
+            and cached['n_components'] >= n_components:
+        eigenvectors = pd.DataFrame(np.asarray(ad.obsm[key])[:, :n_components], index=ad.obs_names)
+        eigenvalues = pd.Series(np.asarray(cached['eigenvalues'])[:n_components])
+    else:
+        dm_res = palantir.utils.run_diffusion_maps(pd.DataFrame(embedding, index=ad.obs_names),
+                                                   n_components=n_components, knn=knn)
+        eigenvectors = dm_res['EigenVectors']
+        eigenvalues = dm_res['EigenValues']
+        if use_cache:
+            ad.obsm[key] = eigenvectors.values
+            ad.uns[key] = {'low_dim_embedding': low_dim_embedding,
+                           'n_components': n_components,
+                           'knn': knn,
+                           'eigenvalues': np.asarray(eigenvalues),
+                           'embedding_fingerprint': fingerprint}
+
+    return palantir.utils.determine_multiscale_space({'EigenValues': eigenvalues, 'EigenVectors': eigenvectors},
+                                                     n_eigs=n_eigs)
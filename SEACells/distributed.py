@@ -0,0 +1,250 @@
+import multiprocessing
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+##########################################################
+# Worker process
+##########################################################
+
+def _block_neighbors(K_block, start, stop):
+    """Sorted indices of the cells in a block and of the cells outside it with non-zero kernel values"""
+    return np.union1d(np.arange(start, stop), K_block.indices)
+
+
+def _frank_wolfe_step(X, amins, t):
+    """
+    Move X towards the vertices given by amins, using the same update as SEACells._updateA and _updateB
+    """
+    e = np.zeros(X.shape)
+    e[amins, np.arange(X.shape[1])] = 1.
+    X += 2. / (t + 2.) * (e - X)
+    return X
+
+
+def _worker_loop(conn, K_block, start, stop, max_iter):
+    """
+    Event loop of a worker holding a block of cells: rows start:stop of the kernel matrix K and the corresponding
+    columns of the assignment matrix A. Each worker also holds a replica of the archetype matrix B, which is kept in
+    sync by applying the same updates on every worker.
+
+    :param conn: (multiprocessing.Connection) connection to the coordinating process
+    :param K_block: (sparse matrix) rows start:stop of K
+    :param start: (int) index of the first cell in the block
+    :param stop: (int) index after the last cell in the block
+    :param max_iter: (int) number of inner iterations for A and B updates
+    """
+    # Columns of K_block outside the block, i.e. neighbors of the block held by other workers
+    neighbors = _block_neighbors(K_block, start, stop)
+    own = np.searchsorted(neighbors, np.arange(start, stop))
+    K_neighbors = K_block.tocsc()[:, neighbors].tocsr()
+
+    A = None
+    B = None
+    KB = None
+    t2 = None
+
+    while True:
+        command, args = conn.recv()
+
+        if command == 'set_A':
+            A = args.copy()
+            conn.send(None)
+
+        elif command == 'set_B':
+            B = args.copy()
+            conn.send(None)
+
+        elif command == 'updateA_t1':
+            # partial sum of t1 = B.T @ K @ B over the cells in the block
+            KB = np.asarray(K_block @ B)
+            conn.send(KB.T @ B[start:stop])
+
+        elif command == 'updateA':
+            t1 = args
+            t2 = KB.T
+            t = 0
+            while t < max_iter:
+                G = 2. * np.array(t1 @ A - t2)
+                A = _frank_wolfe_step(A, np.argmin(G, axis=0), t)
+                t += 1
+            # columns of A have at most max_iter non-zero entries
+            conn.send((csr_matrix(A), t))
+
+        elif command == 'updateB_t1':
+            # partial sum of t1 = A @ A.T, and t2 = K @ A.T restricted to the cells in the block, from the
+            # columns of A held by the worker and those of neighboring cells in other blocks
+            A_neighbors = np.zeros((A.shape[0], len(neighbors)))
+            A_neighbors[:, own] = A
+            external = np.setdiff1d(np.arange(len(neighbors)), own, assume_unique=True)
+            A_neighbors[:, external] = args.toarray()
+            t2 = np.asarray(K_neighbors @ A_neighbors.T)
+            conn.send(A @ A.T)
+
+        elif command == 'updateB_argmin':
+            t1 = args
+            G = 2. * np.array(np.asarray(K_block @ B) @ t1 - t2)
+            amins = np.argmin(G, axis=0)
+            conn.send((G[amins, np.arange(G.shape[1])], amins + start))
+
+        elif command == 'updateB_step':
+            amins, t = args
+            B = _frank_wolfe_step(B, amins, t)
+            conn.send(None)
+
+        elif command == 'close':
+            conn.close()
+            break
+
+
+##########################################################
+# Coordinator
+##########################################################
+
+class LocalCluster:
+    """
+    Pool of worker processes on the local machine that together compute the A and B updates of SEACells.
+
+    Cells are partitioned into contiguous blocks, and each worker holds the columns of A and rows of the kernel
+    matrix K for one block. Inner iterations of the A update run entirely on the workers. Before the B update, each
+    worker receives the columns of A of its neighbors in other blocks, and inner iterations only exchange the
+    k-dimensional argmins of each block and k x k reductions. A is gathered once per update in sparse form, since
+    each of its columns has at most max_iter non-zero entries.
+
+    Workers are started with the 'spawn' method, so that they do not inherit the thread pools of the parent process
+    (e.g. of BLAS or numba), which can deadlock the parent at exit after fork. As with any spawned processes,
+    scripts that fit SEACells with workers must guard their entry point with if __name__ == '__main__'.
+
+    Updates match SEACells._updateA and SEACells._updateB up to floating-point rounding: k x k reductions are summed
+    over blocks rather than computed in a single product, so near-ties in the argmin of an inner iteration may select
+    a different vertex. As in those methods, each update starts from the previous solution, which the workers keep
+    between updates.
+    """
+
+    def __init__(self, K, n_workers: int, max_iter: int = 50):
+        """
+        :param K: (sparse matrix) n x n kernel matrix
+        :param n_workers: (int) number of worker processes
+        :param max_iter: (int) number of inner iterations for A and B updates
+        """
+        self.n = K.shape[0]
+        self.max_iter = max_iter
+        self.blocks = np.array_split(np.arange(self.n), min(n_workers, self.n))
+        self.A = None
+        self.B = None
+
+        # number of inner iterations run by the last A and B updates
+        self.A_iterations = 0
+        self.B_iterations = 0
+
+        K = K.tocsr()
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.processes = []
+        self.external_neighbors = []
+        for block in self.blocks:
+            start, stop = block[0], block[-1] + 1
+            neighbors = _block_neighbors(K[start:stop], start, stop)
+            self.external_neighbors.append(neighbors[(neighbors < start) | (neighbors >= stop)])
+
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_loop,
+                                      args=(child_conn, K[start:stop], start, stop, max_iter),
+                                      daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+
+    def _broadcast(self, command, args=None):
+        """Send the same command to all workers and return their replies in block order"""
+        for conn in self.connections:
+            conn.send((command, args))
+        return [conn.recv() for conn in self.connections]
+
+    def _scatter(self, command, X):
+        """Send the columns of X belonging to each block to the corresponding worker"""
+        for conn, block in zip(self.connections, self.blocks):
+            conn.send((command, X[:, block[0]:block[-1] + 1]))
+        return [conn.recv() for conn in self.connections]
+
+    def updateA(self, B, A_prev):
+        """
+        Given archetype matrix B, compute assignment matrix A. See SEACells._updateA.
+
+        :param B: (array) n*k matrix (dense) defining SEACells as weighted combinations of cells
+        :param A_prev: (array) k*n matrix (dense) initial assignments
+        :return: A: (array) k*n matrix (dense) defining weights used for assigning cells to SEACells
+        """
+        if A_prev is not self.A:
+            self._scatter('set_A', A_prev)
+        if B is not self.B:
+            self._broadcast('set_B', B)
+            self.B = B
+
+        t1 = sum(self._broadcast('updateA_t1'))
+        replies = self._broadcast('updateA', t1)
+        self.A = np.hstack([A_block.toarray() for A_block, _ in replies])
+        self.A_iterations = replies[0][1]
+        return self.A
+
+    def updateB(self, A, B_prev):
+        """
+        Given assignment matrix A, compute archetype matrix B. See SEACells._updateB.
+
+        :param A: (array) k*n matrix (dense) defining weights used for assigning cells to SEACells
+        :param B_prev: (array) n*k matrix (dense) initial archetypes
+        :return: B: (array) n*k matrix (dense) defining SEACells as weighted combinations of cells
+        """
+        if A is not self.A:
+            self._scatter('set_A', A)
+            self.A = A
+        if B_prev is not self.B:
+            self._broadcast('set_B', B_prev)
+            self.B = B_prev
+        B = self.B
+        k = B.shape[1]
+
+        # Each worker receives the columns of A of its neighbors in other blocks
+        for conn, neighbors in zip(self.connections, self.external_neighbors):
+            conn.send(('updateB_t1', csr_matrix(A[:, neighbors])))
+        t1 = sum(conn.recv() for conn in self.connections)
+
+        t = 0
+        while t < self.max_iter:
+            replies = self._broadcast('updateB_argmin', t1)
+            values = np.vstack([r[0] for r in replies])
+            indices = np.vstack([r[1] for r in replies])
+
+            # global argmin, ties resolved towards the first cell as in np.argmin
+            amins = indices[np.argmin(values, axis=0), np.arange(k)]
+
+            self._broadcast('updateB_step', (amins, t))
+            B = _frank_wolfe_step(B, amins, t)
+            t += 1
+
+        self.B = B
+        self.B_iterations = t
+        return B
+
+    def close(self):
+        """Shut down worker processes"""
+        for conn, process in zip(self.connections, self.processes):
+            try:
+                conn.send(('close', None))
+                conn.close()
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            process.close()
+        self.connections, self.processes = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,93 +1,249 @@
-import scanpy as sc
-import anndata
-import palantir
 import pandas as pd
 import numpy as np
 
-import matplotlib.pyplot as plt
-import seaborn as sns
+from .diffusion import diffusion_components
 
-def diffusion_component_variance(ad, low_dim_embedding):
+def _SEACell_groups(ad, SEACells_label='SEACell'):
+    """
+    Indicator matrix of cells in each SEACell, with SEACells in sorted order.
+
+    :return: (1) (sparse matrix) n_SEACells x n_cells indicator matrix, (2) pd.Index of SEACells and
+             (3) (array) index of the SEACell of each cell, or -1 for unassigned cells
+    """
+    from .aggregate import SEACell_indicator
+
+    labels = ad.obs[SEACells_label].values
+    groups = pd.Index(pd.Series(labels).dropna().unique(), name=SEACells_label).sort_values()
+    indicator, groups = SEACell_indicator(labels, groups=groups)
+    return indicator, groups, groups.get_indexer(labels)
+
+
+def _centroids_and_compactness(dc, indicator, codes):
+    """
+    Mean of diffusion components of the cells of each SEACell, and their variance averaged over components.
+
+    :param dc: (array) n_cells x n_components diffusion components
+    :param indicator: (sparse matrix) n_SEACells x n_cells indicator matrix
+    :param codes: (array) index of the SEACell of each cell, or -1 for unassigned cells
+    :return: (1) (array) n_SEACells x n_components centroids and (2) (array) compactness of each SEACell
+    """
+    from .aggregate import aggregate
 
-    import palantir
+    centroids = aggregate(dc, indicator, mode='mean').toarray()
 
-    components = pd.DataFrame(ad.obsm[low_dim_embedding]).set_index(ad.obs_names)
-    dm_res = palantir.utils.run_diffusion_maps(components)
-    dc = palantir.utils.determine_multiscale_space(dm_res, n_eigs=10)
+    # Unbiased variance from squared deviations of cells from their centroid
+    assigned = codes >= 0
+    sq_deviations = np.zeros(dc.shape)
+    sq_deviations[assigned] = (dc[assigned] - centroids[codes[assigned]]) ** 2
+    n_cells = np.ravel(indicator.sum(axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = np.asarray(indicator @ sq_deviations) / (n_cells - 1)[:, None]
+    return centroids, variance.mean(axis=1)
 
-    return pd.DataFrame(dc.join(ad.obs["SEACell"]).groupby("SEACell").var().mean(1)).rename(columns={0:'compactness'})
+
+def _nearest_centroids(centroids, nth_nbr):
+    """Distances to and indices of the nth_nbr nearest SEACells of each SEACell"""
+    from sklearn.neighbors import NearestNeighbors
+
+    return NearestNeighbors(n_neighbors=nth_nbr).fit(centroids).kneighbors()
+
+
+def diffusion_component_variance(ad, low_dim_embedding):
+    """
+    Compactness of each SEACell, as the variance of diffusion components of its cells averaged over components.
+
+    :param ad: (AnnData) annotated data matrix with SEACell assignments in ad.obs['SEACell']
+    :param low_dim_embedding: (str) key of ad.obsm with the embedding on which diffusion components are computed
+    :return: pd.DataFrame with the compactness of each SEACell
+    """
+    dc = diffusion_components(ad, low_dim_embedding, n_eigs=10).values
+    indicator, groups, codes = _SEACell_groups(ad)
+    _, compactness = _centroids_and_compactness(dc, indicator, codes)
+
+    return pd.DataFrame({'compactness': compactness}, index=groups)
 
 
 def diffusion_component_dist_to_NN(ad,
                                    low_dim_embedding,
                                    nth_nbr=1,
                                    cluster=None):
-    components = pd.DataFrame(ad.obsm[low_dim_embedding]).set_index(ad.obs_names)
-    dm_res = palantir.utils.run_diffusion_maps(components)
-    dc = palantir.utils.determine_multiscale_space(dm_res, n_eigs=10)
+    """
+    Separation of each SEACell, as the distance between the mean diffusion components of the SEACell and of its
+    nth_nbr nearest SEACell.
+
+    :param ad: (AnnData) annotated data matrix with SEACell assignments in ad.obs['SEACell']
+    :param low_dim_embedding: (str) key of ad.obsm with the embedding on which diffusion components are computed
+    :param nth_nbr: (int) neighbor to which the distance is computed
+    :param cluster: (str) column of ad.obs with cluster labels. If provided, only SEACells whose neighbor has the
+                    same most frequent cluster are included.
+    :return: pd.DataFrame with the separation of each SEACell
+    """
+    dc = diffusion_components(ad, low_dim_embedding, n_eigs=10).values
+    indicator, groups, codes = _SEACell_groups(ad)
+    centroids, _ = _centroids_and_compactness(dc, indicator, codes)
+    dists, nbrs = _nearest_centroids(centroids, nth_nbr)
 
-    # Compute DC per metacell
-    metacells_dcs = dc.join(ad.obs["SEACell"], how='inner').groupby("SEACell").mean()
+    separation = pd.DataFrame({'separation': dists[:, nth_nbr - 1]}, index=groups)
+    if cluster is not None:
+        # Most frequent cluster of each SEACell must match that of its neighbor
+        from .aggregate import category_composition
+        _, clusters, _, _ = category_composition(ad.obs[cluster], indicator)
+        separation = separation[clusters[nbrs[:, nth_nbr - 1]] == clusters]
 
-    from sklearn.neighbors import NearestNeighbors
-    neigh = NearestNeighbors(n_neighbors=nth_nbr)
-    nbrs = neigh.fit(metacells_dcs)
-    dists, nbrs = nbrs.kneighbors()
-    dists = pd.DataFrame(dists).set_index(metacells_dcs.index)
-    dists.columns += 1
+    return separation
 
-    nbr_cells = np.array(metacells_dcs.index)[nbrs]
 
-    metacells_nbrs = pd.DataFrame(nbr_cells)
-    metacells_nbrs.index = metacells_dcs.index
-    metacells_nbrs.columns += 1
+def compute_SEACell_metrics(ad, low_dim_embedding, celltype_label=None, SEACells_label='SEACell', nth_nbr=1):
+    """
+    Compute quality metrics of SEACells in one pass over the data: compactness (see diffusion_component_variance),
+    separation (see diffusion_component_dist_to_NN) and, if cell type labels are provided, the most frequent
+    cell type and its purity (see compute_celltype_purity).
+
+    :param ad: (AnnData) annotated data matrix with SEACell assignments
+    :param low_dim_embedding: (str) key of ad.obsm with the embedding on which diffusion components are computed
+    :param celltype_label: (str) column of ad.obs with cell type labels
+    :param SEACells_label: (str) column of ad.obs with SEACell assignments
+    :param nth_nbr: (int) neighbor to which separation is computed
+    :return: pd.DataFrame of metrics indexed by SEACell
+    """
+    dc = diffusion_components(ad, low_dim_embedding, n_eigs=10).values
+    indicator, groups, codes = _SEACell_groups(ad, SEACells_label)
+    centroids, compactness = _centroids_and_compactness(dc, indicator, codes)
+    dists, _ = _nearest_centroids(centroids, nth_nbr)
 
-    if cluster is not None:
+    metrics = pd.DataFrame({'compactness': compactness, 'separation': dists[:, nth_nbr - 1]}, index=groups)
+    if celltype_label is not None:
+        from .aggregate import category_composition
+        _, celltype, purity, _ = category_composition(ad.obs[celltype_label], indicator)
+        metrics[celltype_label] = celltype
+        metrics[f'{celltype_label}_purity'] = purity
 
-        # Get cluster type of neighbors to ensure they match the metacell cluster
-        clusters = ad.obs.groupby("SEACell")[cluster].agg(lambda x: x.value_counts().index[0])
-        nbr_clusters = pd.DataFrame(clusters.values[nbrs]).set_index(clusters.index)
-        nbr_clusters.columns = metacells_nbrs.columns
-        nbr_clusters = nbr_clusters.join(pd.DataFrame(clusters))
+    return metrics
 
-        clusters_match = nbr_clusters.eq(nbr_clusters[cluster], axis=0)
-        return pd.DataFrame(dists[nth_nbr][clusters_match[nth_nbr]]).rename(columns={1:'separation'})
-    else:
-        return pd.DataFrame(dists[nth_nbr]).rename(columns={1:'separation'})
 
+def _kth_neighbor_distances(X, k, approximate=False, batch_size=10000):
+    """
+    Distance of each point to its kth nearest neighbor, excluding the point itself. Exact queries are run in
+    batches of points, keeping only the kth distance of each batch.
+
+    :param X: (array) n_points x n_dims data
+    :param k: (int) neighbor to which distances are computed
+    :param approximate: (bool) use approximate nearest neighbors from pynndescent
+    :param batch_size: (int) number of points queried at a time for exact nearest neighbors
+    :return: (array) distance of each point to its kth nearest neighbor
+    """
+    if approximate:
+        try:
+            from pynndescent import NNDescent
+        except ImportError:
+            raise ImportError('pynndescent is required for approximate nearest neighbors. '
+                              'Install it with pip install pynndescent, or use approximate=False.')
+        # The nearest neighbor graph includes each point as its own nearest neighbor
+        return NNDescent(X, n_neighbors=k + 1, random_state=0).neighbor_graph[1][:, k]
 
-def get_density(ad, key, nth_neighbor=150):
+    from sklearn.neighbors import NearestNeighbors
+    nbrs = NearestNeighbors().fit(X)
+    distances = np.empty(X.shape[0])
+    for start in range(0, X.shape[0], batch_size):
+        # Each point is amongst its own nearest neighbors at distance 0
+        distances[start:start + batch_size] = nbrs.kneighbors(X[start:start + batch_size], k + 1)[0][:, k]
+    return distances
+
+
+def _kth_graph_distances(knn_distances, k):
     """
-    Compute cell density as 1/ the distance to the 150th (by default) nearest neighbour.
+    Distance of each point to its kth nearest neighbor in a sparse kNN graph with distances, excluding self.
+
+    :param knn_distances: (sparse matrix) n x n kNN graph with distances
+    :param k: (int) neighbor to which distances are computed. If None, the smallest number of neighbors of any point.
+    :return: (array) distance of each point to its kth nearest neighbor
+    """
+    from scipy.sparse import csr_matrix
+
+    knn_distances = csr_matrix(knn_distances)
+    knn_distances.eliminate_zeros()
+    n_nbrs = np.diff(knn_distances.indptr)
+    if k is None:
+        k = n_nbrs.min()
+    if n_nbrs.min() < k:
+        raise ValueError(f'The kNN graph has {n_nbrs.min()} neighbors for some cells, fewer than nth_neighbor={k}.')
+
+    distances = np.empty(knn_distances.shape[0])
+    for n in np.unique(n_nbrs):
+        rows = np.where(n_nbrs == n)[0]
+        starts = knn_distances.indptr[rows]
+        row_distances = knn_distances.data[starts[:, None] + np.arange(n)]
+        distances[rows] = np.partition(row_distances, k - 1, axis=1)[:, k - 1]
+    return distances
+
+
+def get_density(ad, key, nth_neighbor=None, knn_distances=None, approximate=False, batch_size=10000):
+    """
+    Compute cell density as 1/ the distance to the nth nearest neighbour.
+
+    Distances are computed in diffusion component space of the embedding ad.obsm[key]. Alternatively, an existing
+    kNN graph can be reused, e.g. the graph built for the SEACells kernel (model.kernel_model.knn_distances) or
+    ad.obsp['distances'], if it has at least nth_neighbor neighbors per cell. The SEACells kernel graph has
+    n_neighbors - 1 neighbors per cell.
 
     :param ad: AnnData object
     :param key: (str) key in ad.obsm to use to build diffusion components on.
-    :param nth_neighbor:
+    :param nth_neighbor: (int) neighbor to which distances are computed. Defaults to 150 for diffusion components,
+                         and to the smallest number of neighbors of any cell for knn_distances.
+    :param knn_distances: (sparse matrix or str) kNN graph with distances, excluding self, or key in ad.obsp.
+                          If provided, densities are computed from the graph rather than diffusion components.
+    :param approximate: (bool) use approximate nearest neighbors (requires pynndescent)
+    :param batch_size: (int) number of cells queried at a time for exact nearest neighbors
     :return: pd.DataFrame containing cell ID and density.
     """
-    from sklearn.neighbors import NearestNeighbors
-    neigh = NearestNeighbors(n_neighbors=nth_neighbor)
-
-    if 'key' in ad.obsm:
-        print(f'Using {key} to compute cell density')
-        components = pd.DataFrame(ad.obsm['X_pca']).set_index(ad.obs_names)
+    if knn_distances is not None:
+        if isinstance(knn_distances, str):
+            knn_distances = ad.obsp[knn_distances]
+        distances = _kth_graph_distances(knn_distances, nth_neighbor)
     else:
-        raise ValueError(f'Key {key} not present in ad.obsm.')
-
-    diffusion_map_results = palantir.utils.run_diffusion_maps(components)
-    diffusion_components = palantir.utils.determine_multiscale_space(diffusion_map_results, n_eigs=8)
+        if key not in ad.obsm:
+            raise ValueError(f'Key {key} not present in ad.obsm.')
+        print(f'Using {key} to compute cell density')
+        if nth_neighbor is None:
+            nth_neighbor = 150
 
-    nbrs = neigh.fit(diffusion_components)
-    cell_density = pd.DataFrame(nbrs.kneighbors()[0][:, nth_neighbor - 1]).set_index(ad.obs_names).rename(
-        columns={0: 'density'})
-    density = 1 / cell_density
+        dc = diffusion_components(ad, key, n_eigs=8)
+        distances = _kth_neighbor_distances(dc.values, nth_neighbor, approximate, batch_size)
 
+    density = pd.DataFrame({'density': 1 / distances}, index=ad.obs_names)
     return density
 
 
-def celltype_frac(x, col_name):
-    val_counts = x[col_name].value_counts()
-    return val_counts.values[0] / val_counts.values.sum()
+def compute_SEACell_composition(ad, columns, SEACells_label='SEACell', return_fractions=False):
+    """
+    Compute the composition of categorical annotations within each SEACell in one pass: the most abundant value,
+    its prevalence (purity) and the entropy of the fractions of values, for each column.
+
+    :param ad: (AnnData) annotated data matrix with SEACell assignments and columns in ad.obs
+    :param columns: (list) columns of ad.obs with categorical annotations, e.g. cell types
+    :param SEACells_label: (str) column of ad.obs with SEACell assignments
+    :param return_fractions: (bool) also return the fractions of cells with each value in each SEACell
+    :return: pd.DataFrame indexed by SEACell with columns {col}, {col}_purity and {col}_entropy for each column.
+             If return_fractions is True, also a dictionary of pd.DataFrames of SEACell x value fractions per column.
+    """
+    if isinstance(columns, str):
+        columns = [columns]
+
+    from .aggregate import category_composition
+    indicator, groups, _ = _SEACell_groups(ad, SEACells_label)
+
+    summary = pd.DataFrame(index=groups)
+    fractions = {}
+    for col in columns:
+        col_fractions, majority, purity, entropy = category_composition(ad.obs[col], indicator)
+        summary[col] = majority
+        summary[f'{col}_purity'] = purity
+        summary[f'{col}_entropy'] = entropy
+        fractions[col] = col_fractions.set_index(groups)
+
+    if return_fractions:
+        return summary, fractions
+    return summary
 
 
 def compute_celltype_purity(ad, col_name):
@@ -96,12 +252,4 @@ def compute_celltype_purity(ad, col_name):
     @param: ad - AnnData object with SEACell assignment and col_name in ad.obs dataframe
     @param: col_name - (str) column name within ad.obs representing celltype groupings for each cell.
     """
-
-    celltype_fraction = ad.obs.groupby('SEACell').apply(lambda x: celltype_frac(x, col_name))
-    celltype = ad.obs.groupby('SEACell').apply(lambda x: x[col_name].value_counts().index[0])
-
-    return pd.concat([celltype, celltype_fraction], axis=1).rename(columns={0: col_name, 1: f'{col_name}_purity'})
-
-
-
-
+    return compute_SEACell_composition(ad, [col_name])[[col_name, f'{col_name}_purity']]
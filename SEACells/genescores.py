@@ -1,11 +1,13 @@
+import json
+import os
+import tempfile
+
 from tqdm import tqdm
-import pyranges as pr
-from sklearn.metrics import pairwise_distances
-from scipy.stats import rankdata
 
 import numpy as np
 import pandas as pd
-import scanpy as sc
+
+from .instrument import ProgressCounter
 
 
 def prepare_multiome_anndata(atac_ad, rna_ad, SEACell_label='SEACell', n_bins_for_gc=50):
@@ -14,14 +16,28 @@ def prepare_multiome_anndata(atac_ad, rna_ad, SEACell_label='SEACell', n_bins_fo
     @Manu: rna_ad.X, atac_ad.X must be raw counts?? Yes
 
     """
-    from scipy.sparse import csr_matrix
+    import scanpy as sc
+    from sklearn.feature_extraction.text import TfidfTransformer
+    from .aggregate import SEACell_indicator, aggregate
 
     # Subset of cells common to ATAC and RNA
     common_cells = atac_ad.obs_names.intersection(rna_ad.obs_names)
     if len(common_cells) != atac_ad.shape[0]:
         print('Warning: The number of cells in RNA and ATAC objects are different. Only the common cells will be used.')
-    atac_mod_ad = atac_ad[common_cells, :]
-    rna_mod_ad = rna_ad[common_cells, :]
+
+    def _rows(ad):
+        # Avoid copying the data matrix if cells are already in order
+        if ad.obs_names.equals(common_cells):
+            return ad.X
+        return ad.X[ad.obs_names.get_indexer(common_cells)]
+
+    atac_X = _rows(atac_ad)
+
+    # Cell to metacell indicator, shared by ATAC and RNA
+    labels = atac_ad.obs[SEACell_label][common_cells].astype(str)
+    metacells = labels.unique()
+    metacells = metacells[labels.value_counts()[metacells].values > 1]
+    indicator, metacells = SEACell_indicator(labels.values, groups=metacells)
 
     # #################################################################################
     # Generate metacell matrices
@@ -29,61 +45,36 @@ def prepare_multiome_anndata(atac_ad, rna_ad, SEACell_label='SEACell', n_bins_fo
     print(' ATAC')
 
     # ATAC - Normalize using TFIDF
-    from sklearn.feature_extraction.text import TfidfTransformer
-    mat = atac_mod_ad.X.astype(int)
+    mat = atac_X.astype(int)
     tfidf = TfidfTransformer().fit(mat)
-    atac_mod_ad.layers['TFIDF'] = tfidf.transform(mat)
-
-    # ATAC - Summarize by metacells
-    metacells = atac_mod_ad.obs[SEACell_label].astype(str).unique()
-    metacells = metacells[atac_mod_ad.obs[SEACell_label].value_counts()[
-        metacells] > 1]
-
-    # Summary matrix
-    summ_matrix = pd.DataFrame(
-        0.0, index=metacells, columns=atac_mod_ad.var_names)
-    for m in tqdm(summ_matrix.index):
-        cells = atac_mod_ad.obs_names[atac_mod_ad.obs[SEACell_label] == m]
-        summ_matrix.loc[m, :] = np.ravel(
-            atac_mod_ad[cells, :].layers['TFIDF'].sum(axis=0))
-
-    # ATAC - create metacell anndata
-    atac_meta_ad = sc.AnnData(summ_matrix)
-    atac_meta_ad.X = csr_matrix(atac_meta_ad.X)
-    atac_meta_ad.obs_names, atac_meta_ad.var_names = summ_matrix.index.astype(
-        str), summ_matrix.columns
-    atac_meta_ad = atac_meta_ad[:, atac_mod_ad.var_names]
+
+    # ATAC - Summarize by metacells and create metacell anndata
+    atac_meta_ad = sc.AnnData(aggregate(tfidf.transform(mat), indicator))
+    atac_meta_ad.obs_names, atac_meta_ad.var_names = metacells.astype(str), atac_ad.var_names
+    del mat
     sc.pp.normalize_per_cell(atac_meta_ad)
 
     print(' RNA')
-    # RNA - Normalize
-    sc.pp.normalize_total(rna_mod_ad)
-    sc.pp.log1p(rna_mod_ad)
-
-    # RNA - Summarize by metacells
-    # Summary matrix
-    summ_matrix = pd.DataFrame(
-        0.0, index=metacells, columns=rna_mod_ad.var_names)
-    for m in tqdm(summ_matrix.index):
-        cells = rna_mod_ad.obs_names[atac_mod_ad.obs[SEACell_label] == m]
-        summ_matrix.loc[m, :] = np.ravel(rna_mod_ad[cells, :].X.sum(axis=0))
-
-    # RNA - create metacell matrix
-    rna_meta_ad = sc.AnnData(summ_matrix)
-    rna_meta_ad.X = csr_matrix(rna_meta_ad.X)
-    rna_meta_ad.obs_names, rna_meta_ad.var_names = summ_matrix.index.astype(
-        str), rna_meta_ad.var_names
-
+    # RNA - Normalize in place on a copy of the counts of common cells
+    rna_X = _rows(rna_ad)
+    rna_X = rna_X.copy() if rna_X is rna_ad.X else rna_X
+    if not np.issubdtype(rna_X.dtype, np.floating):
+        rna_X = rna_X.astype(np.float32)
+    rna_norm_ad = sc.AnnData(rna_X)
+    sc.pp.normalize_total(rna_norm_ad)
+    sc.pp.log1p(rna_norm_ad)
+
+    # RNA - Summarize by metacells and create metacell matrix
+    rna_meta_ad = sc.AnnData(aggregate(rna_norm_ad.X, indicator))
+    rna_meta_ad.obs_names, rna_meta_ad.var_names = metacells.astype(str), rna_ad.var_names
+    del rna_norm_ad, rna_X
 
     # #################################################################################
     # Update ATAC meta ad with GC content information
-    atac_mod_ad.var['log_n_counts'] = np.ravel(
-        np.log10(atac_mod_ad.X.sum(axis=0)))
-    atac_meta_ad.var['GC_bin'] = np.digitize(
-        atac_mod_ad.var['GC'], np.linspace(0, 1, n_bins_for_gc))
-    atac_meta_ad.var['counts_bin'] = np.digitize(atac_mod_ad.var['log_n_counts'],
-                                                 np.linspace(atac_mod_ad.var['log_n_counts'].min(),
-                                                             atac_mod_ad.var['log_n_counts'].max(), n_bins_for_gc))
+    log_n_counts = np.ravel(np.log10(atac_X.sum(axis=0)))
+    atac_meta_ad.var['GC_bin'] = np.digitize(atac_ad.var['GC'].values, np.linspace(0, 1, n_bins_for_gc))
+    atac_meta_ad.var['counts_bin'] = np.digitize(log_n_counts,
+                                                 np.linspace(log_n_counts.min(), log_n_counts.max(), n_bins_for_gc))
 
     return atac_meta_ad, rna_meta_ad
 
@@ -92,6 +83,8 @@ def _pyranges_from_strings(pos_list):
     """
     TODO: Documentation
     """
+    import pyranges as pr
+
     # Chromosome and positions
     chr = pos_list.str.split(':').str.get(0)
     start = pd.Series(pos_list.str.split(':').str.get(1)
@@ -120,155 +113,542 @@ def _pyranges_to_strings(peaks):
 
 
 def load_transcripts(path_to_gtf):
+    import pyranges as pr
+
     gtf = pr.read_gtf(path_to_gtf)
     gtf.Chromosome = 'chr' + gtf.Chromosome.astype(str)
     transcripts = gtf[gtf.Feature == 'transcript']
     return transcripts
 
 
-def _peaks_correlations_per_gene(gene,
-                                 atac_exprs,
-                                 rna_exprs,
-                                 atac_meta_ad,
-                                 peaks_pr,
-                                 transcripts,
-                                 span,
-                                 n_rand_sample=100):
-
-    # Gene transcript - use the longest transcript
-    gene_transcripts = transcripts[transcripts.gene_name == gene]
-    if len(gene_transcripts) == 0:
-        return 0
-    longest_transcript = gene_transcripts[
-        np.arange(len(gene_transcripts)) == np.argmax(gene_transcripts.End - gene_transcripts.Start)]
-    start = longest_transcript.Start.values[0] - span
-    end = longest_transcript.End.values[0] + span
-
-    # Gene span
-    gene_pr = pr.from_dict({'Chromosome': [longest_transcript.Chromosome.values[0]],
-                            'Start': [start],
-                            'End': [end]})
-    gene_peaks = peaks_pr.overlap(gene_pr)
-    if len(gene_peaks) == 0:
-        return 0
-    gene_peaks_str = _pyranges_to_strings(gene_peaks)
+def _default_cache_dir():
+    """Directory in which SEACells caches files derived from inputs"""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                        'SEACells')
 
-    # Compute correlations
-    X = atac_exprs.loc[:, gene_peaks_str].T
-    cors = 1 - np.ravel(pairwise_distances(np.apply_along_axis(rankdata, 1, X.values),
-                                           rankdata(rna_exprs[gene].T.values).reshape(
-                                               1, -1),
-                                           metric='correlation'))
-    cors = pd.Series(cors, index=gene_peaks_str)
-
-    # Random background
-    df = pd.DataFrame(1.0, index=cors.index, columns=['cor', 'pval'])
-    df['cor'] = cors
-    for p in df.index:
+
+def load_longest_transcripts(path_to_gtf, use_cache=True, cache_dir=None):
+    """
+    Load the longest transcript of each gene from a GTF file. Parsing a genome-wide GTF file is slow, so the
+    result is cached as a compact .npz file keyed by the path, modification time and size of the GTF file,
+    and loaded from the cache in subsequent calls.
+
+    :param path_to_gtf: (str) path to GTF file with transcript annotations
+    :param use_cache: (bool) whether to read and write the cache
+    :param cache_dir: (str) cache directory. Defaults to $XDG_CACHE_HOME/SEACells or ~/.cache/SEACells.
+    :return: pd.DataFrame indexed by gene name with Chromosome, Start and End of the longest transcript of each gene
+    """
+    import hashlib
+
+    columns = ['Chromosome', 'Start', 'End']
+
+    if use_cache:
+        if cache_dir is None:
+            cache_dir = _default_cache_dir()
+        path_to_gtf = os.path.abspath(path_to_gtf)
+        stat = os.stat(path_to_gtf)
+        key = hashlib.sha1(f'{path_to_gtf}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, f'transcripts-{key}.npz')
+
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                return pd.DataFrame({c: cached[c] for c in columns}, index=cached['gene_name'])
+
+    # Longest transcript of each gene, ties resolved towards the first transcript
+    df = load_transcripts(path_to_gtf).df[columns + ['gene_name']].reset_index(drop=True)
+    df = df.loc[(df['End'] - df['Start']).groupby(df['gene_name'], observed=True, sort=False).idxmax()]
+    df = pd.DataFrame({'Chromosome': df['Chromosome'].astype(str).values,
+                       'Start': df['Start'].values.astype(np.int64),
+                       'End': df['End'].values.astype(np.int64)},
+                      index=pd.Index(df['gene_name'].astype(str).values))
+
+    if use_cache:
         try:
-            # Try random sampling without replacement
-            rand_peaks = np.random.choice(atac_meta_ad.var_names[(atac_meta_ad.var['GC_bin'] == atac_meta_ad.var['GC_bin'][p]) &
-                                                                 (atac_meta_ad.var['counts_bin'] == atac_meta_ad.var['counts_bin'][
-                                                                     p])], n_rand_sample, False)
-        except:
-            rand_peaks = np.random.choice(atac_meta_ad.var_names[(atac_meta_ad.var['GC_bin'] == atac_meta_ad.var['GC_bin'][p]) &
-                                                                 (atac_meta_ad.var['counts_bin'] == atac_meta_ad.var['counts_bin'][
-                                                                     p])], n_rand_sample, True)
-
-        if type(atac_exprs) is sc.AnnData:
-            X = pd.DataFrame(atac_exprs[:, rand_peaks].X.todense().T)
-        else:
-            X = atac_exprs.loc[:, rand_peaks].T
-
-        rand_cors = 1 - np.ravel(pairwise_distances(np.apply_along_axis(rankdata, 1, X.values),
-                                                    rankdata(rna_exprs[gene].T.values).reshape(
-                                                        1, -1),
-                                                    metric='correlation'))
-
-        m = np.mean(rand_cors)
-        v = np.std(rand_cors)
-
-        from scipy.stats import norm
-        df.loc[p, 'pval'] = 1 - norm.cdf(cors[p], m, v)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first, so that concurrent jobs never read a partial cache
+            tmp_file = f'{cache_file}.{os.getpid()}.npz'
+            np.savez(tmp_file, gene_name=df.index.values.astype(str), Chromosome=df['Chromosome'].values.astype(str),
+                     Start=df['Start'].values, End=df['End'].values)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print(f'Warning: Could not cache transcripts in {cache_dir}: {e}')
 
     return df
 
 
+def _standardized_ranks(X, chunk_size=10000):
+    """
+    Rank-transform each column of X and standardize the ranks to zero mean and unit norm, so that the Spearman
+    correlation of any two columns is the dot product of their standardized ranks. Columns with constant values
+    have undefined correlations and are set to NaN.
+
+    :param X: (array or sparse matrix) n_metacells x n_features matrix
+    :param chunk_size: (int) number of columns densified at a time
+    :return: (array) n_metacells x n_features matrix of standardized ranks
+    """
+    from scipy.sparse import issparse
+    from scipy.stats import rankdata
+
+    ranks = np.empty(X.shape)
+    for start in range(0, X.shape[1], chunk_size):
+        chunk = X[:, start:start + chunk_size]
+        chunk = chunk.toarray() if issparse(chunk) else np.asarray(chunk)
+        ranks[:, start:start + chunk_size] = rankdata(chunk, axis=0)
+
+    ranks -= ranks.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ranks /= np.linalg.norm(ranks, axis=0)
+    return ranks
+
+
+def _background_peaks(atac_meta_ad, n_rand_sample=100, random_state=0):
+    """
+    Sample background peaks for each stratum of peaks with similar GC content and accessibility, defined by the
+    'GC_bin' and 'counts_bin' columns of atac_meta_ad.var (see prepare_multiome_anndata). Background peaks are
+    sampled once per stratum and shared by all peaks in the stratum. Peaks are sampled without replacement, unless
+    the stratum has fewer than n_rand_sample peaks.
+
+    :param atac_meta_ad: (AnnData) ATAC metacell AnnData with GC_bin and counts_bin annotations of peaks
+    :param n_rand_sample: (int) number of background peaks per stratum
+    :param random_state: (int) seed of the random number generator
+    :return: (1) (array) stratum of each peak and
+             (2) (array) n_strata x n_rand_sample indices of background peaks of each stratum
+    """
+    peak_strata, strata = pd.MultiIndex.from_arrays([atac_meta_ad.var['GC_bin'],
+                                                     atac_meta_ad.var['counts_bin']]).factorize()
+
+    rng = np.random.default_rng(random_state)
+    order = np.argsort(peak_strata, kind='stable')
+    bounds = np.searchsorted(peak_strata[order], np.arange(len(strata) + 1))
+    background = np.empty((len(strata), n_rand_sample), dtype=np.int64)
+    for s in range(len(strata)):
+        members = order[bounds[s]:bounds[s + 1]]
+        background[s] = rng.choice(members, n_rand_sample, replace=len(members) < n_rand_sample)
+
+    return peak_strata, background
+
+
+def _gene_peak_overlaps(transcripts, peaks, genes, span):
+    """
+    Find the peaks within span of the longest transcript of each gene, using a single sorted search per chromosome.
+
+    :param transcripts: (pd.DataFrame) longest transcript of each gene (see load_longest_transcripts)
+    :param peaks: (pd.Index) peaks in the format chr:start-end
+    :param genes: (list) genes for which overlapping peaks are found
+    :param span: (int) distance from the transcript within which peaks are considered
+    :return: (sparse matrix) n_genes x n_peaks CSR indicator matrix of peaks within span of each gene
+    """
+    from scipy.sparse import csr_matrix
+
+    df = transcripts.reindex(pd.Index(genes).astype(str))
+    gene_chr = df['Chromosome'].astype(str).values
+    gene_start = df['Start'].values - span
+    gene_end = df['End'].values + span
+
+    # Peak coordinates
+    peaks = pd.Series(np.asarray(peaks, dtype=str))
+    peak_chr = peaks.str.split(':').str.get(0).values
+    positions = peaks.str.split(':').str.get(1).str.split('-')
+    peak_start = positions.str.get(0).astype(np.int64).values
+    peak_end = positions.str.get(1).astype(np.int64).values
+
+    rows, cols = [], []
+    for chrom in np.intersect1d(np.unique(peak_chr), gene_chr[~df['Chromosome'].isna().values]):
+        chr_peaks = np.where(peak_chr == chrom)[0]
+        chr_peaks = chr_peaks[np.argsort(peak_start[chr_peaks], kind='stable')]
+        starts = peak_start[chr_peaks]
+        ends = peak_end[chr_peaks]
+        max_length = (ends - starts).max()
+
+        # Peaks overlapping a window start before its end, and cannot start more than max_length before its start
+        chr_genes = np.where(gene_chr == chrom)[0]
+        lo = np.searchsorted(starts, gene_start[chr_genes] - max_length, side='right')
+        hi = np.searchsorted(starts, gene_end[chr_genes], side='left')
+        counts = hi - lo
+        candidates = np.repeat(hi - np.cumsum(counts), counts) + np.arange(counts.sum())
+        candidate_genes = np.repeat(chr_genes, counts)
+        overlapping = ends[candidates] > gene_start[candidate_genes]
+
+        rows.append(candidate_genes[overlapping])
+        cols.append(chr_peaks[candidates[overlapping]])
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    overlaps = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(genes), len(peaks)))
+    overlaps.sort_indices()
+    return overlaps
+
+
+def _peaks_correlations_per_gene(peak_ix,
+                                 atac_ranks,
+                                 gene_ranks,
+                                 peak_strata,
+                                 background):
+    """
+    Compute Spearman correlations between the expression of a gene and the accessibility of peaks within span of
+    its longest transcript, and their p-values against correlations with background peaks of similar GC content and
+    accessibility.
+
+    :param peak_ix: (array) indices of peaks within span of the gene (see _gene_peak_overlaps)
+    :param atac_ranks: (array) n_metacells x n_peaks standardized ranks of peak accessibility (see _standardized_ranks)
+    :param gene_ranks: (array) n_metacells standardized ranks of gene expression
+    :param peak_strata: (array) stratum of each peak (see _background_peaks)
+    :param background: (array) n_strata x n_rand_sample indices of background peaks of each stratum
+    :return: (1) (array) correlation and (2) (array) p-value of each peak
+    """
+    from scipy.stats import norm
+
+    # Compute correlations
+    cors = atac_ranks[:, peak_ix].T @ gene_ranks
+
+    # Null distribution of each stratum with peaks near the gene, from its background peaks
+    strata, inverse = np.unique(peak_strata[peak_ix], return_inverse=True)
+    rand_cors = (atac_ranks[:, background[strata].ravel()].T @ gene_ranks).reshape(len(strata), -1)
+    m = rand_cors.mean(axis=1)[inverse]
+    v = rand_cors.std(axis=1)[inverse]
+
+    return cors, 1 - norm.cdf(cors, m, v)
+
+
+def _peaks_correlations_per_chunk(genes,
+                                  overlaps,
+                                  atac_ranks,
+                                  rna_ranks,
+                                  peak_strata,
+                                  background):
+    """
+    Compute gene-peak correlations and p-values for a chunk of genes (see _peaks_correlations_per_gene).
+
+    :param genes: (array) indices of genes in the chunk
+    :param overlaps: (sparse matrix) n_genes_in_chunk x n_peaks CSR indicator matrix of peaks near each gene
+    :param atac_ranks: (array or str) standardized ranks of peak accessibility, or path to a .npy file to memory-map
+    :param rna_ranks: (array) n_metacells x n_genes_in_chunk standardized ranks of gene expression
+    :return: (1) (array) gene index, (2) (array) peak index, (3) (array) correlation and (4) (array) p-value
+             of each gene-peak pair
+    """
+    if isinstance(atac_ranks, str):
+        atac_ranks = np.load(atac_ranks, mmap_mode='r')
+
+    cors = np.empty(overlaps.nnz)
+    pvals = np.empty(overlaps.nnz)
+    for i in range(len(genes)):
+        start, stop = overlaps.indptr[i], overlaps.indptr[i + 1]
+        if start < stop:
+            cors[start:stop], pvals[start:stop] = _peaks_correlations_per_gene(
+                overlaps.indices[start:stop], atac_ranks, rna_ranks[:, i], peak_strata, background)
+
+    return np.repeat(genes, np.diff(overlaps.indptr)), overlaps.indices.copy(), cors, pvals
+
+
+def _balanced_chunks(costs, n_chunks):
+    """
+    Partition items into chunks of similar total cost, assigning items in decreasing order of cost to the
+    chunk with the lowest total cost (longest processing time first).
+
+    :param costs: (array) cost of each item
+    :param n_chunks: (int) number of chunks
+    :return: (list) arrays of indices of items in each non-empty chunk, in increasing order
+    """
+    import heapq
+
+    loads = [(0, c) for c in range(n_chunks)]
+    assignment = np.empty(len(costs), dtype=np.int64)
+    for item in np.argsort(costs, kind='stable')[::-1]:
+        load, c = heapq.heappop(loads)
+        assignment[item] = c
+        heapq.heappush(loads, (load + costs[item], c))
+
+    chunks = [np.where(assignment == c)[0] for c in range(n_chunks)]
+    return [chunk for chunk in chunks if len(chunk) > 0]
+
+
+def _fingerprint(values):
+    """SHA-1 digest of a sequence of strings, e.g. peak names"""
+    import hashlib
+
+    return hashlib.sha1('\n'.join(np.asarray(values, dtype=str)).encode()).hexdigest()
+
+
+def _read_manifest(output_dir, settings):
+    """
+    Read the chromosomes completed by a previous run of get_gene_peak_correlations from output_dir.
+
+    :param output_dir: (str) directory of stored results
+    :param settings: (dict) inputs and parameters of the current run
+    :return: (list) completed chromosomes
+    """
+    path = os.path.join(output_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest['settings'] != settings:
+        raise ValueError(f'{output_dir} contains results computed with different inputs or parameters. '
+                         f'Use a different output_dir or remove it.')
+    return manifest['completed']
+
+
+def _write_manifest(output_dir, settings, completed):
+    """Write inputs and parameters of the run and completed chromosomes to output_dir"""
+    path = os.path.join(output_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'settings': settings, 'completed': completed}, f)
+    os.replace(path + '.tmp', path)
+
+
+def _write_chromosome(output_dir, chrom, result):
+    """Write gene-peak correlations of the genes of a chromosome to output_dir"""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f'{chrom}.npz')
+    gene_idx, peak_idx, cors, pvals = result
+    np.savez(path + '.tmp.npz', gene_idx=gene_idx, peak_idx=peak_idx, cor=cors, pval=pvals)
+    os.replace(path + '.tmp.npz', path)
+
+
 def get_gene_peak_correlations(atac_meta_ad,
                                rna_meta_ad,
                                path_to_gtf,
                                span=100000,
                                n_jobs=1,
-                               gene_set=None):
+                               gene_set=None,
+                               n_rand_sample=100,
+                               random_state=0,
+                               as_table=False,
+                               use_cache=True,
+                               cache_dir=None,
+                               output_dir=None,
+                               progress=None):
     """
-    TODO: Documentation
-
+    Compute Spearman correlations between the expression of each gene and the accessibility of peaks within span of
+    its longest transcript. P-values are computed against correlations of the gene with background peaks of similar
+    GC content and accessibility.
+
+    :param atac_meta_ad: (AnnData) ATAC metacell AnnData (see prepare_multiome_anndata)
+    :param rna_meta_ad: (AnnData) RNA metacell AnnData (see prepare_multiome_anndata)
+    :param path_to_gtf: (str) path to GTF file with transcript annotations
+    :param span: (int) distance from the transcript within which peaks are considered
+    :param n_jobs: (int) number of parallel jobs
+    :param gene_set: (list) genes for which correlations are computed. If None, all genes are used.
+    :param n_rand_sample: (int) number of background peaks per stratum of GC content and accessibility
+    :param random_state: (int) seed for sampling background peaks
+    :param as_table: (bool) return a long-form table of gene-peak pairs (see gene_peak_correlations_table)
+    :param use_cache: (bool) cache transcript annotations (see load_longest_transcripts)
+    :param cache_dir: (str) directory of the transcript cache
+    :param output_dir: (str) directory in which results are stored as the genes of each chromosome are completed.
+                       If the directory contains results of a previous run with the same inputs and parameters,
+                       completed chromosomes are loaded rather than recomputed.
+    :param progress: (ProgressCounter) counter of processed genes and peaks, which can be read during computation
+    :return: pd.Series with a pd.DataFrame of correlations ('cor') and p-values ('pval') of peaks for each gene,
+             or 0 if the gene has no peaks. If as_table is True, a pd.DataFrame with one row per gene-peak pair.
     """
 
     # #################################################################################
     print('Loading transcripts per gene...')
-    transcripts = load_transcripts(path_to_gtf)
-
-    print('Preparing matrices for gene-peak associations')
-    atac_exprs = pd.DataFrame(atac_meta_ad.X.todense(),
-                              index=atac_meta_ad.obs_names, columns=atac_meta_ad.var_names)
-    rna_exprs = pd.DataFrame(rna_meta_ad.X.todense(),
-                             index=rna_meta_ad.obs_names, columns=rna_meta_ad.var_names)
-    peaks_pr = _pyranges_from_strings(atac_meta_ad.var_names)
+    transcripts = load_longest_transcripts(path_to_gtf, use_cache=use_cache, cache_dir=cache_dir)
 
     print('Computing peak-gene correlations')
     if gene_set is None:
         use_genes = rna_meta_ad.var_names
     else:
         use_genes = gene_set
-    from joblib import Parallel, delayed
-    gene_peak_correlations = Parallel(n_jobs=n_jobs)(delayed(_peaks_correlations_per_gene)(gene,
-                                                                                      atac_exprs,
-                                                                                      rna_exprs,
-                                                                                      atac_meta_ad,
-                                                                                      peaks_pr,
-                                                                                      transcripts,
-                                                                                      span)
-                                                for gene in tqdm(use_genes))
+
+    print('Preparing matrices for gene-peak associations')
+    # Rank transform once, so that Spearman correlations reduce to dot products
+    if not rna_meta_ad.obs_names.equals(atac_meta_ad.obs_names):
+        rna_meta_ad = rna_meta_ad[atac_meta_ad.obs_names]
+    atac_ranks = _standardized_ranks(atac_meta_ad.X)
+    gene_ix = rna_meta_ad.var_names.get_indexer(use_genes)
+    if np.any(gene_ix < 0):
+        raise KeyError(f'Genes {list(pd.Index(use_genes)[gene_ix < 0])} are not present in RNA AnnData.')
+    rna_ranks = _standardized_ranks(rna_meta_ad.X[:, gene_ix])
+    peak_strata, background = _background_peaks(atac_meta_ad, n_rand_sample, random_state)
+
+    print('Finding peaks within span of each gene')
+    overlaps = _gene_peak_overlaps(transcripts, atac_meta_ad.var_names, use_genes, span)
+
+    # Genes are processed in groups: all genes at once, or the genes of each chromosome if results are stored
+    if output_dir is None:
+        groups = {None: np.arange(len(use_genes))}
+        completed = []
+    else:
+        gene_chr = transcripts['Chromosome'].reindex(pd.Index(use_genes).astype(str)).values
+        groups = {chrom: np.where(gene_chr == chrom)[0] for chrom in pd.unique(gene_chr[pd.notna(gene_chr)])}
+        settings = {'genes': [str(g) for g in use_genes],
+                    'peaks': _fingerprint(atac_meta_ad.var_names),
+                    'metacells': _fingerprint(atac_meta_ad.obs_names),
+                    'gtf': os.path.abspath(path_to_gtf),
+                    'span': span,
+                    'n_rand_sample': n_rand_sample,
+                    'random_state': random_state}
+        completed = _read_manifest(output_dir, settings)
+
+    if progress is None:
+        progress = ProgressCounter()
+    n_peaks = np.diff(overlaps.indptr)
+
+    from joblib import Parallel, delayed, effective_n_jobs
+    n_workers = effective_n_jobs(n_jobs)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir, Parallel(n_jobs=n_jobs) as parallel:
+        # Workers memory-map the ranks of peak accessibility rather than receiving a copy with each chunk
+        if n_workers > 1:
+            np.save(os.path.join(tmp_dir, 'atac_ranks.npy'), atac_ranks)
+            atac_ranks = os.path.join(tmp_dir, 'atac_ranks.npy')
+
+        for chrom, genes in groups.items():
+            if chrom in completed:
+                with np.load(os.path.join(output_dir, f'{chrom}.npz')) as stored:
+                    results.append(tuple(stored[k] for k in ('gene_idx', 'peak_idx', 'cor', 'pval')))
+                continue
+
+            # Chunks of genes with similar numbers of peaks, and more chunks than jobs for load balancing
+            chunks = [genes[chunk] for chunk in
+                      _balanced_chunks(n_peaks[genes] + 1, min(len(genes), 4 * n_workers))]
+            chunk_results = parallel(delayed(_peaks_correlations_per_chunk)(chunk,
+                                                                            overlaps[chunk],
+                                                                            atac_ranks,
+                                                                            rna_ranks[:, chunk],
+                                                                            peak_strata,
+                                                                            background)
+                                     for chunk in (tqdm(chunks) if output_dir is None else chunks))
+            result = tuple(np.concatenate(x) for x in zip(*chunk_results))
+            results.append(result)
+            progress.update(genes=len(genes), peaks=n_peaks[genes].sum())
+
+            if output_dir is not None:
+                _write_chromosome(output_dir, chrom, result)
+                completed.append(chrom)
+                _write_manifest(output_dir, settings, completed)
+                print(f'{chrom}: {progress}')
+
+    gene_idx, peak_idx, cors, pvals = [np.concatenate(x) for x in zip(*results)] if results else \
+        [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)]
+
+    # Gene-peak pairs in order of genes and peaks
+    order = np.lexsort((peak_idx, gene_idx))
+    table = pd.DataFrame({'gene': pd.Categorical.from_codes(gene_idx[order], categories=pd.Index(use_genes)),
+                          'peak': pd.Categorical.from_codes(peak_idx[order], categories=atac_meta_ad.var_names),
+                          'cor': cors[order],
+                          'pval': pvals[order]})
+    if as_table:
+        return table
+
+    # One table of peaks per gene
+    bounds = np.searchsorted(table['gene'].cat.codes.values, np.arange(len(use_genes) + 1))
+    gene_peak_correlations = []
+    for i in range(len(use_genes)):
+        if bounds[i] == bounds[i + 1]:
+            gene_peak_correlations.append(0)
+            continue
+        rows = table.iloc[bounds[i]:bounds[i + 1]]
+        gene_peak_correlations.append(pd.DataFrame({'cor': rows['cor'].values, 'pval': rows['pval'].values},
+                                                   index=pd.Index(rows['peak'].astype(str).values)))
     gene_peak_correlations = pd.Series(gene_peak_correlations, index=use_genes)
     return gene_peak_correlations
 
 
-def get_gene_peak_assocations(gene_peak_correlations, pval_cutoff=1e-1, cor_cutoff=0.1):
+def gene_peak_correlations_table(gene_peak_correlations):
     """
-    TODO: Documentation
+    Convert gene-peak correlations to a long-form table with one row per gene-peak pair. Genes and peaks are stored
+    as categoricals, whose categories include genes without peaks. The table can be saved with to_parquet.
 
+    :param gene_peak_correlations: (pd.Series) output of get_gene_peak_correlations, or a table returned with
+                                   as_table=True, which is returned unchanged
+    :return: pd.DataFrame with columns 'gene', 'peak', 'cor' and 'pval'
     """
-    peak_counts = pd.Series(0, index=gene_peak_correlations.index)
-    for gene in tqdm(peak_counts.index):
-        df = gene_peak_correlations[gene]
-        if type(df) is int:
-            continue
-        gene_peaks = df.index[(df['pval'] < pval_cutoff) & (df['cor'] > cor_cutoff)]
-        peak_counts[gene] = len(gene_peaks)
+    if isinstance(gene_peak_correlations, pd.DataFrame):
+        return gene_peak_correlations
 
-    return peak_counts
+    tables = {gene: df for gene, df in gene_peak_correlations.items() if isinstance(df, pd.DataFrame)}
+    genes = np.repeat(list(tables.keys()), [len(df) for df in tables.values()])
+    if len(tables) > 0:
+        pairs = pd.concat(tables.values())
+    else:
+        pairs = pd.DataFrame({'cor': [], 'pval': []})
 
+    table = pd.DataFrame({'gene': pd.Categorical(genes, categories=gene_peak_correlations.index),
+                          'peak': pd.Categorical(pairs.index.values),
+                          'cor': pairs['cor'].values,
+                          'pval': pairs['pval'].values})
+    return table
 
-def get_gene_scores(atac_meta_ad, gene_peak_correlations, pval_cutoff=1e-1, cor_cutoff=0.1):
-    """
-    TODO: Documentation
 
+def _gene_peak_weights(gene_peak_correlations, peaks, pval_cutoff, cor_cutoff, genes=None):
     """
+    Sparse peak x gene matrix of correlations of significant gene-peak pairs.
+
+    :param gene_peak_correlations: (pd.Series or pd.DataFrame) output of get_gene_peak_correlations
+    :param peaks: (pd.Index) peaks indexing the rows of the matrix
+    :param pval_cutoff: (float) gene-peak pairs with p-values below the cutoff are significant
+    :param cor_cutoff: (float) gene-peak pairs with correlations above the cutoff are significant
+    :param genes: (list) genes indexing the columns of the matrix. If None, all genes are used.
+    :return: (1) (sparse matrix) n_peaks x n_genes CSC matrix of correlations of significant pairs,
+             (2) pd.Index of genes and (3) (array) whether each gene has any peaks
     """
-    # Compute the aggregate accessibility of all peaks associated with each gene
-    Gene scores are computed as the aggregate accessibility of all peaks associated with a gene.
-    See .get_gene_peak_correlations() for details on how gene-peak associations are computed.
+    from scipy.sparse import csc_matrix
+
+    table = gene_peak_correlations_table(gene_peak_correlations)
+    gene_codes = pd.Categorical(table['gene'])
+    peak_codes = pd.Categorical(table['peak'])
+    all_genes = gene_codes.categories
+    if genes is None:
+        genes = all_genes
+    genes = pd.Index(genes)
+
+    # Map genes and peaks of the table to the requested genes and peaks
+    missing = all_genes.get_indexer(genes) < 0
+    if np.any(missing):
+        raise KeyError(f'Genes {list(genes[missing])} have no gene-peak correlations.')
+    gene_map = genes.get_indexer(all_genes)
+    peak_map = pd.Index(peaks).get_indexer(peak_codes.categories)
+    gene_ix = gene_map[gene_codes.codes]
+    peak_ix = peak_map[peak_codes.codes]
+    keep = gene_ix >= 0
+    if np.any(peak_ix[keep] < 0):
+        raise KeyError(f'Peaks {list(peak_codes.categories[peak_map < 0][:5])} are not present in ATAC AnnData.')
+
+    has_peaks = np.bincount(gene_ix[keep], minlength=len(genes)) > 0
+    significant = keep & (table['pval'].values < pval_cutoff) & (table['cor'].values > cor_cutoff)
+    weights = csc_matrix((table['cor'].values[significant], (peak_ix[significant], gene_ix[significant])),
+                         shape=(len(peaks), len(genes)))
+    return weights, genes, has_peaks
+
+
+def get_gene_peak_assocations(gene_peak_correlations, pval_cutoff=1e-1, cor_cutoff=0.1):
     """
-    gene_scores = pd.DataFrame(
-        0.0, index=atac_meta_ad.obs_names, columns=gene_peak_correlations.index)
+    Number of peaks significantly correlated with each gene.
 
-    for gene in tqdm(gene_scores.columns):
-        df = gene_peak_correlations[gene]
-        if type(df) is int:
-            continue
-        gene_peaks = df.index[(df['pval'] < pval_cutoff) & (df['cor'] > cor_cutoff)]
-        gene_scores[gene] = np.ravel(np.dot(atac_meta_ad[:, gene_peaks].X.todense(),
-                                            df.loc[gene_peaks, 'cor']))
+    :param gene_peak_correlations: (pd.Series or pd.DataFrame) output of get_gene_peak_correlations
+    :param pval_cutoff: (float) p-value cutoff for gene-peak associations
+    :param cor_cutoff: (float) correlation cutoff for gene-peak associations
+    :return: pd.Series with the number of associated peaks of each gene
+    """
+    table = gene_peak_correlations_table(gene_peak_correlations)
+    significant = (table['pval'] < pval_cutoff) & (table['cor'] > cor_cutoff)
+    peak_counts = table.loc[significant, 'gene'].value_counts(sort=False)
+    peak_counts = peak_counts.reindex(pd.Categorical(table['gene']).categories).astype(int)
+    peak_counts.index.name = None
+    peak_counts.name = None
+    return peak_counts
+
+
+def get_gene_scores(atac_meta_ad, gene_peak_correlations, pval_cutoff=1e-1, cor_cutoff=0.1):
+    """
+    Gene scores are computed as the aggregate accessibility of all peaks associated with a gene, weighted by their
+    correlation with gene expression. See .get_gene_peak_correlations() for details on how gene-peak associations
+    are computed.
+
+    :param atac_meta_ad: (AnnData) ATAC metacell AnnData
+    :param gene_peak_correlations: (pd.Series or pd.DataFrame) output of get_gene_peak_correlations
+    :param pval_cutoff: (float) p-value cutoff for gene-peak associations
+    :param cor_cutoff: (float) correlation cutoff for gene-peak associations
+    :return: pd.DataFrame of metacell x gene scores
+    """
+    weights, genes, _ = _gene_peak_weights(gene_peak_correlations, atac_meta_ad.var_names,
+                                           pval_cutoff, cor_cutoff)
+    scores = atac_meta_ad.X @ weights
+    if hasattr(scores, 'toarray'):
+        scores = scores.toarray()
+    gene_scores = pd.DataFrame(np.asarray(scores, dtype=np.float64), index=atac_meta_ad.obs_names, columns=genes)
     gene_scores = gene_scores.loc[:, (gene_scores.sum() >= 0)]
     return gene_scores
@@ -0,0 +1,164 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class FitMonitor:
+    """
+    Structured instrumentation for SEACells. Records wall time (and optionally peak memory) of each phase of the
+    computation, and statistics of each iteration of the optimization. Records are plain dictionaries, which can be
+    written as JSON lines as they are produced or after fitting.
+
+    A callback can be provided which is called with each iteration record. If the callback returns True,
+    optimization is stopped after the current iteration.
+    """
+
+    def __init__(self, callback=None, track_memory: bool = False, stream=None):
+        """
+        :param callback: (function) called with the record (dict) of each iteration. Return True to stop fitting.
+        :param track_memory: (bool) record peak memory allocated during each phase using tracemalloc. This slows down
+                        computation, and only includes memory allocated through Python (e.g. numpy and scipy arrays).
+                        Requires Python 3.9 or later.
+        :param stream: (str or file object) path or open file to which each record is written as a JSON line
+                        as soon as it is produced. Records are appended to a path, which is only open while a record
+                        is written. If None, records are only kept in memory.
+        """
+        if track_memory and not hasattr(tracemalloc, 'reset_peak'):
+            raise ValueError('Tracking memory requires Python 3.9 or later.')
+
+        self.callback = callback
+        self.track_memory = track_memory
+        self.records = []
+        self.stream = stream
+
+        self._memory_stack = []
+
+    def _emit(self, record):
+        """Store record and write it to stream"""
+        record['timestamp'] = time.time()
+        self.records.append(record)
+        if isinstance(self.stream, str):
+            with open(self.stream, 'a') as f:
+                f.write(json.dumps(record, default=_to_builtin) + '\n')
+        elif self.stream is not None:
+            self.stream.write(json.dumps(record, default=_to_builtin) + '\n')
+            self.stream.flush()
+
+    @contextmanager
+    def phase(self, name, **fields):
+        """
+        Context manager recording the wall time and peak memory of a phase. Phases can be nested.
+
+        :param name: (str) name of phase
+        :param fields: additional fields to include in the record
+        """
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if self._memory_stack:
+                self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            self._memory_stack.append([current, 0])
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'event': 'phase', 'phase': name, 'time': time.perf_counter() - start}
+            record.update(fields)
+
+            if self.track_memory:
+                baseline, child_peak = self._memory_stack.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+                if self._memory_stack:
+                    self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+                record['peak_memory'] = peak - baseline
+
+            self._emit(record)
+
+    def iteration(self, **fields):
+        """
+        Record statistics of an iteration and call the callback.
+
+        :param fields: fields of the record, e.g. iteration number and RSS
+        :return: (bool) True if the callback requested to stop
+        """
+        record = {'event': 'iteration'}
+        record.update(fields)
+        self._emit(record)
+
+        if self.callback is not None:
+            return bool(self.callback(record))
+        return False
+
+    def phase_times(self):
+        """
+        Total wall time spent in each phase
+        :return: (dict) phase name -> time in seconds
+        """
+        times = {}
+        for record in self.records:
+            if record['event'] == 'phase':
+                times[record['phase']] = times.get(record['phase'], 0) + record['time']
+        return times
+
+    def to_jsonl(self, path):
+        """
+        Write all records to a file as JSON lines
+        :param path: (str) path of output file
+        """
+        with open(path, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=_to_builtin) + '\n')
+
+    def close(self):
+        """Close stream and stop tracing memory allocations"""
+        if self.stream is not None and not isinstance(self.stream, str):
+            self.stream.close()
+        self.stream = None
+        if self.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def _to_builtin(value):
+    """Convert numpy scalars to Python builtins for JSON serialization"""
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class ProgressCounter:
+    """
+    Counts of processed items, e.g. genes and peaks, and their throughput since the counter was created. Counters
+    are plain attributes, which can be read from another thread during processing.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.start = time.perf_counter()
+
+    def update(self, **counts):
+        """
+        Add processed items
+        :param counts: number of processed items of each kind, e.g. genes=10
+        """
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + int(count)
+
+    def elapsed(self):
+        """Wall time in seconds since the counter was created"""
+        return time.perf_counter() - self.start
+
+    def rates(self):
+        """
+        Throughput of each kind of item
+        :return: (dict) name -> items per second
+        """
+        elapsed = max(self.elapsed(), 1e-12)
+        return {name: count / elapsed for name, count in self.counts.items()}
+
+    def __str__(self):
+        rates = self.rates()
+        return ', '.join(f'{count} {name} ({rates[name]:.1f} {name}/s)' for name, count in self.counts.items())
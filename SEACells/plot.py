@@ -1,7 +1,49 @@
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba
 import seaborn as sns
+import numpy as np
 import pandas as pd
 
+
+def _plot_histogram(values, bins=None):
+    """
+    Plot the density histogram of an array of values, computed with numpy
+
+    :param values: (array) values
+    :param bins: (int) number of bins. If None, determined from the data.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    density, edges = np.histogram(values, bins='auto' if bins is None else bins, density=True)
+    plt.stairs(density, edges, fill=True, color='C0', alpha=0.4)
+    plt.stairs(density, edges, color='C0')
+    plt.ylabel('Density')
+
+
+def _rasterize(coords, colors, shape, extent):
+    """
+    Render points as an RGBA image with one pixel per grid bin. Each pixel takes the colour of the last point
+    falling in it, as if points were drawn in order.
+
+    :param coords: (array) n_points x 2 coordinates
+    :param colors: (array) n_points x 4 RGBA colours
+    :param shape: (int, int) number of pixels in y and x
+    :param extent: (float, float, float, float) xmin, xmax, ymin, ymax of the grid
+    :return: (array) shape[0] x shape[1] x 4 image, with transparent empty pixels
+    """
+    xmin, xmax, ymin, ymax = extent
+    ny, nx = shape
+    ix = np.clip(((coords[:, 0] - xmin) / (xmax - xmin) * nx).astype(np.int64), 0, nx - 1)
+    iy = np.clip(((coords[:, 1] - ymin) / (ymax - ymin) * ny).astype(np.int64), 0, ny - 1)
+
+    # Last point in each pixel: first occurrence in reversed order
+    pixels = (iy * nx + ix)[::-1]
+    occupied, first = np.unique(pixels, return_index=True)
+    image = np.zeros((ny * nx, 4))
+    image[occupied] = colors[::-1][first]
+    return image.reshape(ny, nx, 4)
+
+
 def plot_assignment_entropy(ad,
                             title='Entropy of Metacell Assignment',
                             save_as = None,
@@ -21,7 +63,7 @@ def plot_assignment_entropy(ad,
     """
 
     plt.figure(figsize=figsize)
-    sns.distplot(ad.obs['Metacell_Entropy'], bins=bins)
+    _plot_histogram(ad.obs['Metacell_Entropy'].values, bins=bins)
     plt.title(title)
     sns.despine()
     
@@ -38,7 +80,9 @@ def plot_2D(ad, key='X_umap',
             cmap='Set2',
             figsize=(5,5),
             SEACell_size = 20,
-            cell_size=10
+            cell_size=10,
+            rasterize=False,
+            pixels=500
             ):
     """
     Plot 2D visualization of metacells using the embedding provided in 'key'.
@@ -50,37 +94,69 @@ def plot_2D(ad, key='X_umap',
     :param save_as: (str or None) file name to which figure is saved
     :param cmap: (str) matplotlib colormap for metacells. Default: 'Set2'
     :param figsize: (int,int) tuple of integers representing figure size
+    :param SEACell_size: (int) marker size of SEACells
+    :param cell_size: (int) marker size of cells. Ignored if rasterize is True.
+    :param rasterize: (bool) whether to render cells as an image, with each cell filling one pixel of a grid over
+                      the embedding, instead of drawing a marker per cell. SEACells are drawn as markers. Rendering
+                      time and file size do not grow with the number of cells, which is recommended for large datasets.
+    :param pixels: (int) number of pixels along the x axis of the rasterized image
     """
-    umap = pd.DataFrame(ad.obsm[key]).set_index(ad.obs_names).join(ad.obs['SEACell'])
-    mcs = umap.loc[ad.obs['SEACell'].unique()]
+    coords = np.asarray(ad.obsm[key])[:, :2]
+    labels = ad.obs['SEACell']
+    codes, SEACells = pd.factorize(labels)
+    centers = ad.obs_names.get_indexer(SEACells)
+    centers = centers[centers >= 0]
 
     plt.figure(figsize=figsize)
-    if colour_metacells:
-        sns.scatterplot(x=0, y=1,
-                        hue='SEACell',
-                        data=umap,
-                        s=cell_size,
-                        cmap=cmap,
-                        legend=None)
-        sns.scatterplot(x=0, y=1, s=SEACell_size,
-                        hue='SEACell',
-                        data=mcs,
-                        cmap=cmap,
-                        edgecolor='black', linewidth=1.25,
-                        legend=None)
+    if rasterize:
+        cmap = plt.get_cmap(cmap)
+        if colour_metacells:
+            colors = cmap(codes % cmap.N)
+            colors[codes < 0] = (0.5, 0.5, 0.5, 1)
+        else:
+            colors = np.tile(to_rgba('grey'), (len(coords), 1))
+
+        xmin, ymin = coords.min(axis=0)
+        xmax, ymax = coords.max(axis=0)
+        xmax, ymax = max(xmax, xmin + 1e-12), max(ymax, ymin + 1e-12)
+        shape = (max(int(round(pixels * figsize[1] / figsize[0])), 1), pixels)
+        plt.imshow(_rasterize(coords, colors, shape, (xmin, xmax, ymin, ymax)),
+                   extent=(xmin, xmax, ymin, ymax), origin='lower', aspect='auto', interpolation='nearest')
+        plt.scatter(coords[centers, 0], coords[centers, 1], s=SEACell_size,
+                    c=colors[centers] if colour_metacells else 'red',
+                    edgecolor='black', linewidth=1.25)
+        plt.xlim(xmin, xmax)
+        plt.ylim(ymin, ymax)
+
     else:
-        sns.scatterplot(x=0, y=1,
-                        color='grey',
-                        data=umap,
-                        s=cell_size,
-                        cmap=cmap,
-                        legend=None)
-        sns.scatterplot(x=0, y=1, s=SEACell_size,
-                        color='red',
-                        data=mcs,
-                        cmap=cmap,
-                        edgecolor='black', linewidth=1.25,
-                        legend=None)
+        umap = pd.DataFrame(coords).set_index(ad.obs_names).join(labels)
+        mcs = umap.iloc[centers]
+        if colour_metacells:
+            sns.scatterplot(x=0, y=1,
+                            hue='SEACell',
+                            data=umap,
+                            s=cell_size,
+                            cmap=cmap,
+                            legend=None)
+            sns.scatterplot(x=0, y=1, s=SEACell_size,
+                            hue='SEACell',
+                            data=mcs,
+                            cmap=cmap,
+                            edgecolor='black', linewidth=1.25,
+                            legend=None)
+        else:
+            sns.scatterplot(x=0, y=1,
+                            color='grey',
+                            data=umap,
+                            s=cell_size,
+                            cmap=cmap,
+                            legend=None)
+            sns.scatterplot(x=0, y=1, s=SEACell_size,
+                            color='red',
+                            data=mcs,
+                            cmap=cmap,
+                            edgecolor='black', linewidth=1.25,
+                            legend=None)
 
     plt.xlabel(f'{key}-0')
     plt.ylabel(f'{key}-1')
@@ -110,9 +186,11 @@ def plot_SEACell_sizes(ad,
     """
 
     assert 'SEACell' in ad.obs, 'AnnData must contain "SEACell" in obs DataFrame.'
-    label_df = ad.obs[['SEACell']].reset_index()
+    codes, SEACells = pd.factorize(ad.obs['SEACell'], sort=True)
+    sizes = np.bincount(codes[codes >= 0], minlength=len(SEACells))
+
     plt.figure(figsize=figsize)
-    sns.distplot(label_df.groupby('SEACell').count().iloc[:, 0], bins=bins)
+    _plot_histogram(sizes, bins=bins)
     sns.despine()
     plt.xlabel('Number of Cells per SEACell')
     plt.title(title)
@@ -121,4 +199,5 @@ def plot_SEACell_sizes(ad,
         plt.savefig(save_as)
     plt.show()
     plt.close()
-    return pd.DataFrame(label_df.groupby('SEACell').count().iloc[:, 0]).rename(columns={'index':'size'})
+    return pd.DataFrame({'size': sizes}, index=pd.Index(SEACells, name='SEACell'))
+
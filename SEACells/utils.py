@@ -1,6 +1,8 @@
-import scanpy as sc
 import os
 
+import numpy as np
+import pandas as pd
+
 _ROOT = os.path.abspath(os.path.dirname(__file__))
 def get_data(path):
     """
@@ -23,9 +25,25 @@ def load_data():
     Get absolute path for loading sample data
     :return: (anndata.AnnData object) sample dataset
     """
+    import scanpy as sc
+
     p = get_data('sample_data.h5ad')
     return sc.read(p)
 
+def _read_lines(path):
+    """
+    Read names written one per line, e.g. by writeLines in R, without parsing missing values or delimiters.
+    :param path: (str) path to file
+    :return: (array) names in the file
+    """
+    with open(path, encoding='utf-8') as f:
+        lines = f.read().split('\n')
+    # Drop the empty string following the final newline
+    if lines[-1] == '':
+        lines = lines[:-1]
+    return np.array(lines, dtype=object)
+
+
 def chromVAR_R(outdir):
     """
     Given an output directory containing:
@@ -33,24 +51,36 @@ def chromVAR_R(outdir):
         - sampling_depth.txt
         - peak_names.txt
         - cell_names.txt
-        - counts.txt
+        - counts.mtx (peaks x cells counts in MatrixMarket format)
     Executes chromVAR R script and writes output files to same directory:
-        - deviations.csv
+        - deviations.bin
+        - motif_names.txt
         - variability.csv
-        - deviationScores.csv
+
+    Output of the R script is printed as it runs.
 
     Loads and returns
     (1) pd.Dataframe containing deviations and
     (2) pd.Dataframe containing variability
     """
-
     import subprocess
-    result = subprocess.run(['Rscript', get_Rscript('chromVAR.R'), outdir], stdout=subprocess.PIPE)
-    print('Executing command:', ' '.join(['Rscript', 'run_chromVAR.R', outdir]))
-    display(result.stdout.decode("utf-8"))
 
-    deviations = pd.read_csv(outdir + 'deviations.csv', index_col=[0])
-    variability = pd.read_csv(outdir + 'variability.csv', index_col=[0])
+    command = ['Rscript', get_Rscript('chromVAR.R'), outdir]
+    print('Executing command:', ' '.join(command))
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as process:
+        for line in process.stdout:
+            print(line, end='')
+    if process.returncode != 0:
+        raise RuntimeError(f'chromVAR R script failed with exit code {process.returncode}.')
+
+    # Deviations are written as little-endian doubles in column-major (R) order of a motifs x cells matrix
+    cells = _read_lines(os.path.join(outdir, 'cell_names.txt'))
+    motifs = _read_lines(os.path.join(outdir, 'motif_names.txt'))
+    deviations = np.fromfile(os.path.join(outdir, 'deviations.bin'), dtype='<f8').reshape(len(cells), len(motifs))
+    deviations = pd.DataFrame(deviations.T, index=motifs, columns=cells)
+    variability = pd.read_csv(os.path.join(outdir, 'variability.csv'), index_col=[0])
+    # Rows of variability are in the order of motifs, whose names may be parsed as missing values in the csv
+    variability.index = motifs
 
     return deviations, variability
 
@@ -58,42 +88,52 @@ def chromVAR_R(outdir):
 def run_chromVAR(ad, outdir):
     """
     Run chromVAR Rscript on anndata object and output deviations to outdir.
-    Writes the following files in outdir:
+    Writes the following files in outdir, without densifying counts:
         - peaks.bed
         - sampling_depth.txt
         - peak_names.txt
         - cell_names.txt
-        - counts.txt
+        - counts.mtx
 
     Executes chromVAR_R() - runs chromVAR R script and writes output files to same directory:
-        - deviations.csv
+        - deviations.bin
+        - motif_names.txt
         - variability.csv
-        - deviationScores.csv
+
+    See chromvar.compute_deviations for a native implementation that does not require R.
 
     Loads and returns
     (1) pd.Dataframe containing deviations and
     (2) pd.Dataframe containing variability
     """
+    from scipy.io import mmwrite
+    from scipy.sparse import csr_matrix
+
     # Create output directory
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-    # Convert ad to counts matrix
-    atac_df = ad.to_df()
-
     # Drop zero-count peaks
-    atac_df = atac_df.T[atac_df.T.sum(1) > 0]
-    ad[:, atac_df.index].var[['seqnames', 'start', 'end']].to_csv(outdir+ 'peaks.bed', index=False, sep='\t', header=None)
-    atac_df.to_csv(outdir  + 'counts.txt', index=True, sep='\t')
-    atac_df.sum(0).to_csv(outdir + 'sampling_depth.txt', index=True, sep='\t')
-
-    np.savetxt(outdir + 'peak_names.txt', atac_df.index.values, fmt='%s')
-    np.savetxt(outdir + 'cell_names.txt', atac_df.columns.values, fmt='%s')
+    X = csr_matrix(ad.X)
+    keep = np.ravel(X.sum(axis=0)) > 0
+    X = X[:, keep]
+    peaks = ad.var_names[keep]
+
+    ad.var.loc[peaks, ['seqnames', 'start', 'end']].to_csv(os.path.join(outdir, 'peaks.bed'),
+                                                           index=False, sep='\t', header=None)
+    mmwrite(os.path.join(outdir, 'counts.mtx'), X.T.tocoo())
+    with open(os.path.join(outdir, 'sampling_depth.txt'), 'w') as f:
+        f.write('\n'.join(map(str, np.ravel(X.sum(axis=1)))) + '\n')
+    with open(os.path.join(outdir, 'peak_names.txt'), 'w') as f:
+        f.write('\n'.join(peaks) + '\n')
+    with open(os.path.join(outdir, 'cell_names.txt'), 'w') as f:
+        f.write('\n'.join(ad.obs_names) + '\n')
 
     print("Finished writing input files to chromVAR...")
 
     return chromVAR_R(outdir)
 
+
 def tanay_metacells():
 
     raise NotImplementedError
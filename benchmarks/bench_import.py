@@ -0,0 +1,67 @@
+"""
+Benchmark of package import time.
+
+Each repeat imports SEACells in a fresh interpreter, accesses SEACells.core, and records the wall time and which
+heavy dependencies were loaded. Importing the package and using core must not load plotting, genomics or machine
+learning libraries.
+
+Usage: python benchmarks/bench_import.py [--repeats 5] [--output import.json]
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'scanpy', 'pyranges', 'palantir', 'sklearn', 'joblib']
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import SEACells
+SEACells.core.SEACells
+elapsed = time.perf_counter() - start
+print(json.dumps({'time': elapsed, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % HEAVY_MODULES
+
+
+def time_import(repeats=5):
+    """
+    Time importing SEACells and accessing SEACells.core in fresh interpreters
+
+    :param repeats: (int) number of interpreters
+    :return: (dict) import times in seconds and heavy modules loaded by the import
+    """
+    times = []
+    loaded = set()
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', _SCRIPT], capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(result['time'])
+        loaded.update(result['loaded'])
+
+    return {'benchmark': 'import',
+            'repeats': repeats,
+            'times': times,
+            'min_time': min(times),
+            'heavy_modules_loaded': sorted(loaded)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark import time of SEACells')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help='path of JSON output. Printed if not provided.')
+    args = parser.parse_args()
+
+    result = time_import(args.repeats)
+    if args.output is None:
+        print(json.dumps(result, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if result['heavy_modules_loaded']:
+        sys.exit(f'Importing SEACells.core loaded {", ".join(result["heavy_modules_loaded"])}')
+
+
+if __name__ == '__main__':
+    main()
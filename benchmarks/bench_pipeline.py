@@ -0,0 +1,182 @@
+"""
+Benchmark of each stage of the SEACells pipeline on synthetic multiome data.
+
+For each configuration of number of cells, embedding dimensions, SEACells and peaks, a dataset is simulated (see
+synthetic.py) and the wall time and peak memory of each stage are recorded with instrument.FitMonitor. Peak memory
+is measured with tracemalloc and includes only memory allocated through Python, e.g. numpy and scipy arrays.
+Results are written as JSON, so that versions can be compared offline. Before the timed runs, the pipeline is run
+once on a small dataset, so that just-in-time compilation of dependencies (e.g. numba in scanpy) is not timed.
+
+Usage: python benchmarks/bench_pipeline.py --n-cells 2000 10000 --n-peaks 20000 --output pipeline.json
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from synthetic import simulate_multiome, write_gtf
+
+STAGES = ['rbf', 'greedy_centers', 'waypoint_centers', 'updateA', 'updateB', 'compute_RSS', 'summarize_by_SEACell',
+          'prepare_multiome_anndata', 'gene_peak_correlations', 'open_peaks']
+
+
+def _environment():
+    """Versions of Python, SEACells and its main dependencies, and the git commit of the source tree"""
+    from importlib.metadata import version
+    import SEACells
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'SEACells': SEACells.__version__,
+            'commit': commit,
+            **{package: version(package) for package in ['numpy', 'scipy', 'pandas', 'anndata', 'scanpy']}}
+
+
+def run_pipeline(n_cells, n_dims, n_SEACells, n_peaks, n_genes=2000, n_neighbors=15, stages=None, track_memory=True,
+                 seed=0, workdir=None):
+    """
+    Time the stages of the pipeline on one synthetic dataset
+
+    :param n_cells: (int) number of cells
+    :param n_dims: (int) number of dimensions of the embedding on which the kernel is built
+    :param n_SEACells: (int) number of SEACells
+    :param n_peaks: (int) number of ATAC peaks
+    :param n_genes: (int) number of genes
+    :param n_neighbors: (int) number of neighbors of the kernel
+    :param stages: (list) stages to run. Stages required by later stages are always run. If None, all stages are run.
+    :param track_memory: (bool) record peak memory of each stage
+    :param seed: (int) random seed of the simulation and of SEACells initialization
+    :param workdir: (str) directory for the GTF file
+    :return: (dict) stage -> {'time': seconds, 'peak_memory': bytes}
+    """
+    import SEACells
+    from SEACells.instrument import FitMonitor
+
+    stages = STAGES if stages is None else stages
+    monitor = FitMonitor(track_memory=track_memory)
+
+    rna_ad, atac_ad, genes = simulate_multiome(n_cells=n_cells, n_dims=n_dims, n_genes=n_genes, n_peaks=n_peaks,
+                                               seed=seed)
+    np.random.seed(seed)
+
+    # Kernel and initialization
+    with monitor.phase('rbf'):
+        graph = SEACells.build_graph.SEACellGraph(rna_ad, 'X_pca', verbose=False)
+        K = graph.rbf(n_neighbors)
+
+    model = SEACells.core.SEACells(rna_ad, 'X_pca', n_SEACells=n_SEACells, n_neighbors=n_neighbors, verbose=False)
+    model.K = K
+    model.kernel_model = graph
+
+    with monitor.phase('greedy_centers'):
+        centers = model._get_greedy_centers(n_mcs=n_SEACells)
+    if 'waypoint_centers' in stages:
+        with monitor.phase('waypoint_centers'):
+            model._get_waypoint_centers(n_SEACells)
+
+    # One update of each assignment matrix
+    k = len(centers)
+    B = np.zeros((n_cells, k))
+    B[centers, np.arange(k)] = 1
+    A = np.random.random((k, n_cells))
+    A /= A.sum(0)
+    with monitor.phase('updateA'):
+        A = model._updateA(B, A)
+    with monitor.phase('updateB'):
+        B = model._updateB(A, B.copy())
+    if 'compute_RSS' in stages:
+        with monitor.phase('compute_RSS'):
+            model.compute_RSS(A, B)
+
+    labels = rna_ad.obs_names[centers][np.argmax(A, axis=0)]
+    rna_ad.obs['SEACell'] = labels
+    atac_ad.obs['SEACell'] = labels
+    if 'summarize_by_SEACell' in stages:
+        with monitor.phase('summarize_by_SEACell'):
+            SEACells.core.summarize_by_SEACell(rna_ad, SEACells_label='SEACell', summarize_layer='raw')
+
+    # ATAC
+    if {'prepare_multiome_anndata', 'gene_peak_correlations', 'open_peaks'} & set(stages):
+        with monitor.phase('prepare_multiome_anndata'):
+            atac_meta_ad, rna_meta_ad = SEACells.genescores.prepare_multiome_anndata(atac_ad, rna_ad)
+
+        if 'gene_peak_correlations' in stages:
+            gtf = os.path.join(workdir, 'genes.gtf')
+            write_gtf(genes, gtf)
+            with monitor.phase('gene_peak_correlations'):
+                SEACells.genescores.get_gene_peak_correlations(atac_meta_ad, rna_meta_ad, gtf, use_cache=False)
+
+        if 'open_peaks' in stages:
+            from sklearn.decomposition import TruncatedSVD
+            atac_meta_ad.obsm['X_svd'] = TruncatedSVD(n_components=min(30, min(atac_meta_ad.shape) - 1),
+                                                      random_state=seed).fit_transform(atac_meta_ad.X)
+            with monitor.phase('open_peaks'):
+                SEACells.accessibility.determine_metacell_open_peaks(atac_meta_ad, low_dim_embedding='X_svd')
+
+    monitor.close()
+    results = {}
+    for record in monitor.records:
+        if record['phase'] in stages:
+            results[record['phase']] = {key: record[key] for key in ('time', 'peak_memory') if key in record}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark stages of the SEACells pipeline on synthetic data. '
+                                                 'All combinations of the listed sizes are run.')
+    parser.add_argument('--n-cells', type=int, nargs='+', default=[5000])
+    parser.add_argument('--n-dims', type=int, nargs='+', default=[50])
+    parser.add_argument('--n-SEACells', type=int, nargs='+', default=None,
+                        help='number of SEACells. Defaults to one SEACell per 75 cells.')
+    parser.add_argument('--n-peaks', type=int, nargs='+', default=[20000])
+    parser.add_argument('--n-genes', type=int, default=2000)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='do not record peak memory, which slows down stages')
+    parser.add_argument('--no-warmup', action='store_true', help='do not run the pipeline on a small dataset first')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='path of JSON output. Printed if not provided.')
+    args = parser.parse_args()
+
+    # Progress messages of the pipeline are redirected to stderr, so that JSON can be printed to stdout
+    results = []
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        if not args.no_warmup:
+            print('Warming up', file=sys.stderr)
+            run_pipeline(n_cells=300, n_dims=10, n_SEACells=5, n_peaks=1000, n_genes=100, stages=args.stages,
+                         track_memory=False, seed=args.seed, workdir=workdir)
+
+        for n_cells, n_dims, n_SEACells, n_peaks in itertools.product(args.n_cells, args.n_dims,
+                                                                      args.n_SEACells or [None], args.n_peaks):
+            config = {'n_cells': n_cells, 'n_dims': n_dims, 'n_SEACells': n_SEACells or max(n_cells // 75, 2),
+                      'n_peaks': n_peaks, 'n_genes': args.n_genes}
+            for repeat in range(args.repeats):
+                print(f'Running {config}, repeat {repeat}', file=sys.stderr)
+                stages = run_pipeline(**config, stages=args.stages, track_memory=not args.no_memory,
+                                      seed=args.seed, workdir=workdir)
+                results.append({'config': config, 'repeat': repeat, 'stages': stages})
+
+    output = {'benchmark': 'pipeline', 'environment': _environment(), 'results': results}
+    if args.output is None:
+        print(json.dumps(output, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Synthetic multiome datasets for benchmarks.
+
+Cells are sampled around cluster centers in a low-dimensional space, which is used as the PCA and SVD embeddings.
+RNA and ATAC counts are sampled from Poisson distributions with cluster-specific rates, so that dataset size can be
+scaled independently in number of cells, embedding dimensions, genes and peaks. Genes and peaks are placed on
+synthetic chromosomes, and gene annotations can be written as a GTF file for gene-peak correlations.
+"""
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack
+
+
+def _poisson_counts(rates, clusters, depth, rng, chunk_size=1e7):
+    """
+    Sparse Poisson counts of each cell, sampled in chunks of cells to bound memory
+
+    :param rates: (array) n_clusters x n_features relative rates of each feature, summing to 1 in each cluster
+    :param clusters: (array) cluster of each cell
+    :param depth: (array) expected total counts of each cell
+    :param chunk_size: (int) maximum number of dense values sampled at a time
+    :return: (sparse matrix) n_cells x n_features CSR matrix of counts
+    """
+    chunk_size = max(1, int(chunk_size // rates.shape[1]))
+    chunks = []
+    for start in range(0, len(clusters), chunk_size):
+        end = min(start + chunk_size, len(clusters))
+        counts = rng.poisson(rates[clusters[start:end]] * depth[start:end, None]).astype(np.float32)
+        chunks.append(csr_matrix(counts))
+    return vstack(chunks).tocsr()
+
+
+def _positions(n, n_chromosomes, chromosome_length, rng):
+    """Sorted random positions of n features, distributed evenly over chromosomes"""
+    chromosomes = np.sort(np.arange(n) % n_chromosomes)
+    starts = np.empty(n, dtype=np.int64)
+    for c in range(n_chromosomes):
+        ix = np.where(chromosomes == c)[0]
+        starts[ix] = np.sort(rng.choice(chromosome_length, len(ix), replace=False))
+    return pd.Series([f'chr{c + 1}' for c in chromosomes]), starts
+
+
+def simulate_multiome(n_cells=5000, n_dims=50, n_genes=2000, n_peaks=20000, n_clusters=10, n_chromosomes=5,
+                      rna_depth=2000, atac_depth=5000, seed=0):
+    """
+    Simulate paired RNA and ATAC data of the same cells
+
+    :param n_cells: (int) number of cells
+    :param n_dims: (int) number of dimensions of the X_pca and X_svd embeddings
+    :param n_genes: (int) number of genes
+    :param n_peaks: (int) number of peaks
+    :param n_clusters: (int) number of clusters of cells
+    :param n_chromosomes: (int) number of chromosomes over which genes and peaks are placed
+    :param rna_depth: (int) mean RNA counts per cell
+    :param atac_depth: (int) mean ATAC fragments per cell
+    :param seed: (int) seed of the random number generator
+    :return: (1) RNA AnnData with counts in .X and .raw and embedding in obsm['X_pca'],
+             (2) ATAC AnnData with counts in .X, GC content in var['GC'] and embedding in obsm['X_svd'] and
+             (3) pd.DataFrame of gene annotations with Chromosome, Start and End, indexed by gene (see write_gtf)
+    """
+    import anndata
+
+    rng = np.random.default_rng(seed)
+
+    # Cells around cluster centers
+    clusters = rng.integers(0, n_clusters, n_cells)
+    centers = rng.normal(scale=5, size=(n_clusters, n_dims))
+    embedding = centers[clusters] + rng.normal(size=(n_cells, n_dims))
+    obs_names = pd.Index([f'cell_{i}' for i in range(n_cells)])
+
+    # Genome: 5kb per peak, so that peaks are sparse relative to gene spans
+    chromosome_length = max(n_peaks * 5000 // n_chromosomes, 10 * n_genes)
+
+    # RNA: cluster-specific log-normal expression programs
+    gene_rates = rng.lognormal(sigma=1.5, size=(n_clusters, n_genes))
+    gene_rates /= gene_rates.sum(axis=1, keepdims=True)
+    rna_counts = _poisson_counts(gene_rates, clusters, rng.lognormal(np.log(rna_depth), 0.3, n_cells), rng)
+    rna_ad = anndata.AnnData(rna_counts, obs=pd.DataFrame(index=obs_names),
+                             var=pd.DataFrame(index=[f'gene_{i}' for i in range(n_genes)]))
+    rna_ad.obsm['X_pca'] = embedding
+    rna_ad.obs['cluster'] = pd.Categorical(clusters)
+    rna_ad.raw = rna_ad
+
+    chromosomes, starts = _positions(n_genes, n_chromosomes, chromosome_length, rng)
+    genes = pd.DataFrame({'Chromosome': chromosomes.values, 'Start': starts,
+                          'End': starts + rng.integers(1000, 50000, n_genes)}, index=rna_ad.var_names)
+
+    # ATAC: each cluster opens a random subset of peaks
+    peak_rates = rng.lognormal(size=(n_clusters, n_peaks)) * np.where(rng.random((n_clusters, n_peaks)) < 0.2, 10, 1)
+    peak_rates /= peak_rates.sum(axis=1, keepdims=True)
+    atac_counts = _poisson_counts(peak_rates, clusters, rng.lognormal(np.log(atac_depth), 0.3, n_cells), rng)
+
+    chromosomes, starts = _positions(n_peaks, n_chromosomes, chromosome_length, rng)
+    peak_names = chromosomes + ':' + pd.Series(starts).astype(str) + '-' + pd.Series(starts + 500).astype(str)
+    atac_ad = anndata.AnnData(atac_counts, obs=pd.DataFrame(index=obs_names),
+                              var=pd.DataFrame(index=peak_names.values))
+    atac_ad.var['GC'] = rng.beta(5, 5, n_peaks)
+    atac_ad.obsm['X_svd'] = embedding
+    atac_ad.obs['cluster'] = rna_ad.obs['cluster']
+
+    return rna_ad, atac_ad, genes
+
+
+def write_gtf(genes, path):
+    """
+    Write gene annotations as a GTF file with one transcript per gene. Chromosomes are written without the 'chr'
+    prefix, which is added by genescores.load_transcripts.
+
+    :param genes: (pd.DataFrame) gene annotations from simulate_multiome
+    :param path: (str) path of GTF file
+    """
+    with open(path, 'w') as f:
+        for i, (gene, row) in enumerate(genes.iterrows()):
+            f.write(f'{row["Chromosome"][3:]}\tsynthetic\ttranscript\t{row["Start"] + 1}\t{row["End"]}\t.\t+\t.\t'
+                    f'gene_id "G{i}"; transcript_id "T{i}"; gene_name "{gene}"; gene_type "protein_coding";\n')
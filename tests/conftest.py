@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def simulate_cells(n_cells=400, n_dims=10, n_genes=50, n_clusters=4, seed=0):
+    """
+    Small AnnData with cells around cluster centers in obsm['X_pca'] and Poisson counts in .X
+
+    :param n_cells: (int) number of cells
+    :param n_dims: (int) number of dimensions of the embedding
+    :param n_genes: (int) number of genes
+    :param n_clusters: (int) number of clusters
+    :param seed: (int) seed of the random number generator
+    :return: anndata.AnnData
+    """
+    import anndata
+    from scipy.sparse import csr_matrix
+
+    rng = np.random.default_rng(seed)
+    clusters = np.arange(n_cells) % n_clusters
+    centers = rng.normal(scale=5, size=(n_clusters, n_dims))
+    rates = rng.lognormal(size=(n_clusters, n_genes))
+
+    ad = anndata.AnnData(csr_matrix(rng.poisson(rates[clusters]).astype(np.float32)),
+                         obs=pd.DataFrame(index=[f'cell_{i}' for i in range(n_cells)]),
+                         var=pd.DataFrame(index=[f'gene_{i}' for i in range(n_genes)]))
+    ad.obsm['X_pca'] = centers[clusters] + rng.normal(size=(n_cells, n_dims))
+    ad.obs['celltype'] = pd.Categorical([f'type_{c}' for c in clusters])
+    return ad
+
+
+@pytest.fixture
+def ad():
+    return simulate_cells()
+
+
+@pytest.fixture(scope='module')
+def fitted():
+    """Model fitted on simulated cells, shared by the tests of a module"""
+    import SEACells
+
+    ad = simulate_cells()
+    np.random.seed(0)
+    model = SEACells.core.SEACells(ad, 'X_pca', n_SEACells=8, verbose=False)
+    model.fit(n_iter=5)
+    return model
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+
+from SEACells import chromvar
+
+
+@pytest.fixture
+def atac():
+    import anndata
+
+    rng = np.random.default_rng(0)
+    n_cells, n_peaks = 60, 300
+    counts = rng.poisson(rng.lognormal(size=n_peaks) * 2, size=(n_cells, n_peaks)) + 1
+    ad = anndata.AnnData(csr_matrix(counts.astype(float)),
+                         obs=pd.DataFrame(index=[f'cell_{i}' for i in range(n_cells)]),
+                         var=pd.DataFrame(index=[f'peak_{i}' for i in range(n_peaks)]))
+    ad.var['GC'] = rng.random(n_peaks)
+    return ad
+
+
+@pytest.fixture
+def motifs(atac):
+    rng = np.random.default_rng(1)
+    return pd.DataFrame(rng.random((atac.shape[1], 4)) < 0.2, index=atac.var_names,
+                        columns=['m1', 'm2', 'm3', 'm4'])
+
+
+def test_deviations_match_background_iterations(atac, motifs):
+    n_iterations = 10
+    deviations, scores = chromvar.compute_deviations(atac, motifs, n_iterations=n_iterations, n_neighbors=20,
+                                                     n_jobs=2)
+
+    # Reference: deviations of each background peak set, with variance computed in two passes
+    annotations, _ = chromvar._annotation_matrix(motifs, atac.var_names)
+    X = csr_matrix(atac.X)
+    depth = np.ravel(X.sum(axis=1))
+    expected = np.ravel(X.sum(axis=0)) / X.sum()
+    raw = chromvar._raw_deviations(X, depth, expected, annotations)
+    background = chromvar.background_peaks(atac, n_iterations, 20)
+    n = X.shape[1]
+    bg = np.stack([chromvar._raw_deviations(X, depth, expected, (csr_matrix(
+        (np.ones(n), (background[:, i], np.arange(n))), shape=(n, n)) @ annotations).tocsc())
+        for i in range(n_iterations)])
+
+    np.testing.assert_allclose(deviations.values, raw - bg.mean(axis=0))
+    np.testing.assert_allclose(scores.values, (raw - bg.mean(axis=0)) / bg.std(axis=0, ddof=1))
+
+
+def test_deviations_require_two_iterations(atac, motifs):
+    with pytest.raises(ValueError):
+        chromvar.compute_deviations(atac, motifs, n_iterations=1)
@@ -0,0 +1,25 @@
+import numpy as np
+import palantir
+
+import SEACells
+from SEACells.diffusion import diffusion_components
+
+
+def test_cache_shared_by_fit_and_evaluation(fitted, monkeypatch):
+    ad = fitted.ad
+    cached = diffusion_components(ad, 'X_pca', n_eigs=10, n_components=10)
+
+    # Metrics reuse the components computed for waypoint initialization
+    def run_diffusion_maps(*args, **kwargs):
+        raise AssertionError('Diffusion maps were recomputed.')
+
+    monkeypatch.setattr(palantir.utils, 'run_diffusion_maps', run_diffusion_maps)
+    SEACells.evaluate.compute_SEACell_metrics(ad, 'X_pca')
+    np.testing.assert_allclose(diffusion_components(ad, 'X_pca', n_eigs=10, n_components=10).values, cached.values)
+
+
+def test_cache_recomputed_for_more_components(ad):
+    diffusion_components(ad, 'X_pca', n_eigs=4, n_components=5)
+    assert ad.obsm['DC_X_pca_30'].shape[1] == 5
+    diffusion_components(ad, 'X_pca', n_eigs=4, n_components=8)
+    assert ad.obsm['DC_X_pca_30'].shape[1] == 8
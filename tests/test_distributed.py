@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+import SEACells
+from SEACells.distributed import LocalCluster
+
+from conftest import simulate_cells
+
+
+def _fit(n_workers):
+    ad = simulate_cells()
+    np.random.seed(0)
+    model = SEACells.core.SEACells(ad, 'X_pca', n_SEACells=8, verbose=False, n_workers=n_workers)
+    model.fit(n_iter=5)
+    return model
+
+
+def test_fit_matches_serial():
+    serial = _fit(1)
+    distributed = _fit(3)
+
+    np.testing.assert_allclose(distributed.A_, serial.A_)
+    np.testing.assert_allclose(distributed.B_, serial.B_)
+    assert (distributed.ad.obs['SEACell'] == serial.ad.obs['SEACell']).all()
+
+
+def test_updates_match_serial():
+    n, k = 300, 6
+    K = sparse_random(n, n, density=0.05, format='csr', random_state=0)
+    K = K + K.T
+    ad = simulate_cells(n_cells=n)
+    model = SEACells.core.SEACells(ad, 'X_pca', n_SEACells=k, verbose=False, max_iter=10)
+    model.K = K
+
+    rng = np.random.default_rng(0)
+    B = np.zeros((n, k))
+    B[rng.choice(n, k, replace=False), np.arange(k)] = 1
+    A = rng.random((k, n))
+    A /= A.sum(0)
+
+    with LocalCluster(K, 4, max_iter=10) as cluster:
+        # A not computed by the workers is scattered to them before the B update
+        np.testing.assert_allclose(cluster.updateB(A, B.copy()), model._updateB(A, B.copy()))
+        A_serial = model._updateA(B, A.copy())
+        A_distributed = cluster.updateA(B, A.copy())
+        np.testing.assert_allclose(A_distributed, A_serial)
+        np.testing.assert_allclose(cluster.updateB(A_distributed, B.copy()), model._updateB(A_serial, B.copy()))
+
+
+def test_process_exits(tmp_path):
+    script = tmp_path / 'fit.py'
+    script.write_text(textwrap.dedent(f'''
+        import sys
+        sys.path.insert(0, {os.path.dirname(__file__)!r})
+        from test_distributed import _fit
+
+        if __name__ == '__main__':
+            _fit(2)
+            print('fitted')
+    '''))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=600, env=env)
+
+    assert result.returncode == 0, result.stderr
+    assert 'fitted' in result.stdout
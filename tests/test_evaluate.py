@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from SEACells import evaluate
+
+
+def test_density_from_kernel_graph(fitted):
+    knn_distances = fitted.kernel_model.knn_distances
+    density = evaluate.get_density(fitted.ad, 'X_pca', knn_distances=knn_distances)
+
+    # The kernel graph holds the n_neighbors - 1 nearest neighbors of each cell, excluding self
+    n_nbrs = np.diff(knn_distances.tocsr().indptr).min()
+    distances, _ = NearestNeighbors(n_neighbors=n_nbrs + 1).fit(fitted.ad.obsm['X_pca']).kneighbors()
+    assert density.index.equals(fitted.ad.obs_names)
+    np.testing.assert_allclose(density['density'], 1 / distances[:, n_nbrs - 1], rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        evaluate.get_density(fitted.ad, 'X_pca', nth_neighbor=n_nbrs + 1, knn_distances=knn_distances)
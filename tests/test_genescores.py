@@ -0,0 +1,101 @@
+import json
+import os
+
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+
+from SEACells import genescores
+
+
+@pytest.fixture
+def multiome(tmp_path):
+    """Metacell ATAC and RNA AnnData objects and a GTF file with genes on two chromosomes"""
+    rng = np.random.default_rng(0)
+    n_metacells, n_peaks = 30, 80
+    metacells = [f'SEACell-{i}' for i in range(n_metacells)]
+
+    chroms = np.repeat(['chr1', 'chr2'], n_peaks // 2)
+    starts = np.tile(np.arange(n_peaks // 2) * 5000 + 1000, 2)
+    peaks = [f'{c}:{s}-{s + 500}' for c, s in zip(chroms, starts)]
+    atac_meta_ad = anndata.AnnData(rng.random((n_metacells, n_peaks)),
+                                   obs=pd.DataFrame(index=metacells), var=pd.DataFrame(index=peaks))
+    atac_meta_ad.var['GC_bin'] = rng.integers(0, 2, n_peaks)
+    atac_meta_ad.var['counts_bin'] = rng.integers(0, 2, n_peaks)
+
+    genes = [f'gene_{i}' for i in range(6)]
+    rna_meta_ad = anndata.AnnData(rng.random((n_metacells, len(genes))),
+                                  obs=pd.DataFrame(index=metacells), var=pd.DataFrame(index=genes))
+
+    # Genes 0-2 on chromosome 1 and genes 3-5 on chromosome 2, written without the chr prefix
+    lines = []
+    for i, gene in enumerate(genes):
+        start = 20000 + (i % 3) * 50000
+        attributes = f'gene_id "{gene}"; transcript_id "{gene}.1"; gene_name "{gene}";'
+        lines.append('\t'.join([str(i // 3 + 1), 'test', 'transcript', str(start), str(start + 10000), '.', '+', '.',
+                                attributes]))
+    path_to_gtf = tmp_path / 'genes.gtf'
+    path_to_gtf.write_text('\n'.join(lines) + '\n')
+
+    return atac_meta_ad, rna_meta_ad, str(path_to_gtf)
+
+
+def _correlations(multiome, tmp_path, **kwargs):
+    atac_meta_ad, rna_meta_ad, path_to_gtf = multiome
+    return genescores.get_gene_peak_correlations(atac_meta_ad, rna_meta_ad, path_to_gtf, span=20000, n_rand_sample=10,
+                                                 as_table=True, cache_dir=str(tmp_path / 'cache'), **kwargs)
+
+
+def test_resume_from_partial_output(multiome, tmp_path, monkeypatch):
+    output_dir = str(tmp_path / 'output')
+    expected = _correlations(multiome, tmp_path)
+    np.testing.assert_array_equal(expected['gene'].cat.codes.unique(), np.arange(6))
+    pd.testing.assert_frame_equal(_correlations(multiome, tmp_path, output_dir=output_dir), expected)
+
+    # Interrupt after chromosome 1: chromosome 2 is missing from the manifest and its partial file is removed
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    assert manifest['completed'] == ['chr1', 'chr2']
+    manifest['completed'] = ['chr1']
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    os.remove(os.path.join(output_dir, 'chr2.npz'))
+
+    computed = []
+    per_chunk = genescores._peaks_correlations_per_chunk
+
+    def _record(genes, *args):
+        computed.extend(genes)
+        return per_chunk(genes, *args)
+
+    monkeypatch.setattr(genescores, '_peaks_correlations_per_chunk', _record)
+    pd.testing.assert_frame_equal(_correlations(multiome, tmp_path, output_dir=output_dir), expected)
+    assert sorted(computed) == [3, 4, 5]
+    with open(manifest_path) as f:
+        assert json.load(f)['completed'] == ['chr1', 'chr2']
+
+
+def test_resume_with_different_settings(multiome, tmp_path):
+    output_dir = str(tmp_path / 'output')
+    _correlations(multiome, tmp_path, output_dir=output_dir)
+
+    with pytest.raises(ValueError):
+        _correlations(multiome, tmp_path, output_dir=output_dir, random_state=1)
+
+
+def test_all_jobs(multiome, tmp_path, monkeypatch):
+    expected = _correlations(multiome, tmp_path, n_jobs=1)
+
+    chunks = []
+    per_chunk = genescores._peaks_correlations_per_chunk
+
+    def _record(genes, *args):
+        chunks.append(genes)
+        return per_chunk(genes, *args)
+
+    monkeypatch.setattr(genescores, '_peaks_correlations_per_chunk', _record)
+    pd.testing.assert_frame_equal(_correlations(multiome, tmp_path, n_jobs=-1), expected)
+    assert len(chunks) > 1
+    assert sorted(np.concatenate(chunks)) == list(range(6))
@@ -0,0 +1,47 @@
+import numpy as np
+
+import SEACells
+from SEACells.build_graph import SEACellGraph
+
+from conftest import simulate_cells
+
+
+def test_add_points_matches_rbf():
+    ad = simulate_cells(n_cells=400)
+    graph = SEACellGraph(ad[:300].copy(), 'X_pca', n_cores=1)
+    graph.rbf(15)
+    K_incremental = graph.add_points(ad.copy())
+
+    full = SEACellGraph(ad.copy(), 'X_pca', n_cores=1)
+    K_full = full.rbf(15)
+
+    assert K_incremental.shape == K_full.shape
+    np.testing.assert_allclose(K_incremental.toarray(), K_full.toarray(), atol=1e-10)
+    np.testing.assert_allclose(graph.median_distances, full.median_distances)
+    np.testing.assert_allclose(graph.knn_distances.toarray(), full.knn_distances.toarray(), rtol=1e-5)
+
+
+def test_fit_incremental():
+    ad = simulate_cells(n_cells=400)
+    np.random.seed(0)
+    model = SEACells.core.SEACells(ad[:300].copy(), 'X_pca', n_SEACells=8, verbose=False)
+    model.fit(n_iter=3)
+
+    # Two SEACells sharing a center
+    model.B_[:, 1] = model.B_[:, 0]
+    greedy_centers = model._get_greedy_centers
+    fixed = []
+
+    def _get_greedy_centers(**kwargs):
+        fixed.append(kwargs['fixed_centers'])
+        return greedy_centers(**kwargs)
+
+    model._get_greedy_centers = _get_greedy_centers
+    model.fit_incremental(ad, n_new_SEACells=3, max_iter=3)
+
+    assert len(fixed[0]) == len(np.unique(fixed[0]))
+    assert model.A_.shape == (11, 400)
+    np.testing.assert_allclose(model.A_.sum(axis=0), 1)
+    new_centers = model.get_centers()[8:]
+    assert np.all(new_centers >= 300)
+    assert ad.obs['SEACell'].notna().all()
@@ -0,0 +1,46 @@
+import json
+
+import numpy as np
+
+import SEACells
+from SEACells.instrument import FitMonitor
+
+from conftest import simulate_cells
+
+
+def test_fit_records(tmp_path):
+    path = tmp_path / 'fit.jsonl'
+    monitor = FitMonitor(stream=str(path))
+    np.random.seed(0)
+    model = SEACells.core.SEACells(simulate_cells(), 'X_pca', n_SEACells=8, max_iter=7, verbose=False,
+                                   monitor=monitor)
+    model.fit(n_iter=3)
+
+    iterations = [record for record in monitor.records if record['event'] == 'iteration']
+    assert len(iterations) > 0
+    assert all(record['A_iterations'] == 7 and record['B_iterations'] == 7 for record in iterations)
+
+    with open(path) as f:
+        written = [json.loads(line) for line in f]
+    assert [record['event'] for record in written] == [record['event'] for record in monitor.records]
+
+
+def test_fixed_B_records_no_B_iterations():
+    ad = simulate_cells()
+    B = np.zeros((ad.shape[0], 4))
+    B[[0, 1, 2, 3], np.arange(4)] = 1
+    model = SEACells.core.SEACells(ad, 'X_pca', n_SEACells=4, max_iter=5, verbose=False, true_B=B)
+    model.fit(n_iter=2)
+
+    iterations = [record for record in model.monitor.records if record['event'] == 'iteration']
+    assert all(record['A_iterations'] == 5 and record['B_iterations'] == 0 for record in iterations)
+
+
+def test_phase_memory():
+    monitor = FitMonitor(track_memory=True)
+    with monitor.phase('allocate'):
+        x = np.ones(10 ** 6)
+    del x
+    monitor.close()
+
+    assert monitor.records[0]['peak_memory'] >= 8 * 10 ** 6
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import SEACells
+
+
+def _summarize_per_SEACell(ad, SEACells_label, X):
+    """Reference implementation: sum the rows of X over the cells of each SEACell, one SEACell at a time"""
+    metacells = ad.obs[SEACells_label].unique()
+    summary = np.zeros((len(metacells), X.shape[1]))
+    for i, m in enumerate(metacells):
+        cells = np.where(ad.obs[SEACells_label] == m)[0]
+        summary[i] = np.ravel(X[cells].sum(axis=0))
+    return metacells.astype(str), summary
+
+
+@pytest.fixture
+def labelled(ad):
+    rng = np.random.default_rng(1)
+    ad.obs['SEACell'] = np.asarray(ad.obs_names)[rng.integers(0, 20, ad.shape[0])]
+    return ad
+
+
+def test_summarize_raw(labelled):
+    labelled.raw = labelled.copy()
+    labelled.X = np.log1p(labelled.X)
+    meta_ad = SEACells.core.summarize_by_SEACell(labelled, summarize_layer='raw')
+
+    metacells, expected = _summarize_per_SEACell(labelled, 'SEACell', labelled.raw.X)
+    assert list(meta_ad.obs_names) == list(metacells)
+    np.testing.assert_allclose(meta_ad.X.toarray(), expected)
+
+
+def test_summarize_raw_layer_without_raw(labelled):
+    labelled.layers['raw'] = labelled.X.copy()
+    labelled.X = np.log1p(labelled.X)
+    meta_ad = SEACells.core.summarize_by_SEACell(labelled, summarize_layer='raw')
+
+    metacells, expected = _summarize_per_SEACell(labelled, 'SEACell', labelled.layers['raw'])
+    assert list(meta_ad.obs_names) == list(metacells)
+    np.testing.assert_allclose(meta_ad.X.toarray(), expected)
+
+
+def test_summarize_raw_missing(labelled):
+    with pytest.raises(ValueError):
+        SEACells.core.summarize_by_SEACell(labelled, summarize_layer='raw')
+
+
+def test_summarize_on_disk(labelled, tmp_path):
+    labelled.layers['raw'] = labelled.X.copy()
+    labelled.layers['counts'] = labelled.X.copy() * 2
+    labelled.X = np.log1p(labelled.X)
+    path = tmp_path / 'cells.h5ad'
+    labelled.write_h5ad(path)
+
+    in_memory = SEACells.core.summarize_by_SEACell(labelled, summarize_layer='raw', layers=['counts'], mode='mean')
+    on_disk = SEACells.core.summarize_by_SEACell_on_disk(str(path), str(tmp_path / 'meta.h5ad'),
+                                                         summarize_layer='raw', layers=['counts'], mode='mean',
+                                                         obs_columns=['celltype'], chunk_size=37)
+
+    assert on_disk.obs_names.equals(in_memory.obs_names)
+    assert on_disk.var_names.equals(in_memory.var_names)
+    np.testing.assert_allclose(on_disk.X.toarray(), in_memory.X.toarray())
+    np.testing.assert_allclose(on_disk.layers['counts'].toarray(), in_memory.layers['counts'].toarray())
+    assert 'celltype' in on_disk.obs
@@ -0,0 +1,37 @@
+import anndata
+import numpy as np
+
+from conftest import simulate_cells
+
+
+def test_transform_training_cells(fitted):
+    df, A = fitted.transform(fitted.ad)
+
+    # Training cells are assigned by the A update against the fitted B and kernel
+    B = fitted.B_
+    t2 = np.asarray((fitted.K @ B).T)
+    expected = fitted._solveA(B.T @ fitted.K @ B, t2, np.zeros(t2.shape))
+    np.testing.assert_allclose(A, expected.T)
+    np.testing.assert_allclose(A, fitted.A_.T, atol=0.2)
+
+    assert df.index.equals(fitted.ad.obs_names)
+    assert (df['SEACell'] == fitted.get_assignments()['SEACell']).mean() >= 0.95
+
+
+def test_transform_new_cells(fitted):
+    new = simulate_cells(n_cells=50, seed=1)
+    new.obs_names = [f'new_{i}' for i in range(new.shape[0])]
+    df, A = fitted.transform(new)
+
+    assert A.shape == (50, fitted.k)
+    np.testing.assert_allclose(A.sum(1), 1)
+    assert df['SEACell'].isin(fitted.ad.obs['SEACell']).all()
+
+    # Training cells given together with new cells keep their assignments and order
+    mixed = anndata.concat([new[:20], fitted.ad[:30], new[20:]])
+    df_mixed, A_mixed = fitted.transform(mixed)
+    _, A_training = fitted.transform(fitted.ad[:30])
+    assert df_mixed.index.equals(mixed.obs_names)
+    np.testing.assert_allclose(A_mixed[20:50], A_training)
+    np.testing.assert_allclose(A_mixed[:20], A[:20])
+    np.testing.assert_allclose(A_mixed[50:], A[20:])
@@ -0,0 +1,48 @@
+import os
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from SEACells import utils
+
+
+class _Rscript:
+    """Stand-in for the chromVAR R script, writing outputs as the script does"""
+
+    def __init__(self, command, **kwargs):
+        outdir = command[-1]
+        with open(os.path.join(outdir, 'cell_names.txt')) as f:
+            n_cells = len(f.read().split('\n')) - 1
+        motifs = ['NA', 'null', '', 'MA0001.1,FOXA1', 'nan']
+        deviations = np.arange(len(motifs) * n_cells, dtype=float).reshape(n_cells, len(motifs))
+        deviations.astype('<f8').tofile(os.path.join(outdir, 'deviations.bin'))
+        with open(os.path.join(outdir, 'motif_names.txt'), 'w') as f:
+            f.write('\n'.join(motifs) + '\n')
+        pd.DataFrame({'variability': np.ones(len(motifs))}, index=motifs).to_csv(
+            os.path.join(outdir, 'variability.csv'))
+
+        self.stdout = iter(['Finished writing files.\n'])
+        self.returncode = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def test_chromVAR_R_names(tmp_path, monkeypatch):
+    cells = ['NA', 'cell,1', '', 'nan', 'cell 2']
+    with open(tmp_path / 'cell_names.txt', 'w') as f:
+        f.write('\n'.join(cells) + '\n')
+    monkeypatch.setattr(subprocess, 'Popen', _Rscript)
+
+    deviations, variability = utils.chromVAR_R(str(tmp_path))
+
+    motifs = ['NA', 'null', '', 'MA0001.1,FOXA1', 'nan']
+    assert list(deviations.columns) == cells
+    assert list(deviations.index) == motifs
+    # Column-major motifs x cells matrix
+    np.testing.assert_array_equal(deviations.values, np.arange(25, dtype=float).reshape(5, 5).T)
+    assert list(variability.index) == motifs